@@ -0,0 +1,61 @@
+"""
+Micro-benchmark of the row conversion done by DerivaCSV.upload_to_deriva.  Compares the per-cell branch chain that
+to_json used to run and a list comprehension over the conversion functions with the precompiled converter from
+row_converter.
+
+    python benchmark_row_converter.py [rows]
+"""
+from __future__ import print_function
+import sys
+import random
+import string
+import timeit
+
+from deriva.utils.catalog.manage.deriva_csv import row_converter, value_conversion
+
+# The same mix of column types as the test tables, with a fifth of the values missing.
+field_types = ['integer'] + [['integer', 'boolean', 'number', 'date', 'string'][i % 5] for i in range(20)]
+values = {
+    'integer': lambda: str(random.randrange(-1000, 1000)),
+    'boolean': lambda: random.choice(['true', 'false']),
+    'number': lambda: str(random.uniform(-1000, 1000)),
+    'date': lambda: '2020-01-{:02d} 10:00:00'.format(random.randrange(1, 29)),
+    'string': lambda: ''.join(random.sample(string.ascii_letters + string.digits, 5)),
+}
+
+
+def branch_chain(row):
+    for idx, (v, t) in enumerate(zip(row, field_types)):
+        if t in ['boolean', 'integer', 'number', 'date'] and v == '':
+            row[idx] = None
+        else:
+            if t == 'boolean':
+                row[idx] = True if row[idx] == 'true' else False
+            if t == 'integer':
+                row[idx] = int(v)
+            if t == 'number':
+                row[idx] = float(v)
+            if 'date' in t and v == '':
+                row[idx] = None
+    return row
+
+
+def main(row_count=100000):
+    random.seed(0)
+    table = [[values[t]() if random.random() > .2 else '' for t in field_types] for _ in range(row_count)]
+
+    convert = row_converter(field_types)
+    converters = [value_conversion(t)[1] for t in field_types]
+
+    def comprehension(row):
+        return [c(v) for c, v in zip(converters, row)]
+
+    assert all(branch_chain(list(row)) == comprehension(row) == convert(row) for row in table[:1000])
+
+    for name, fn in [('branch chain', branch_chain), ('comprehension', comprehension), ('row_converter', convert)]:
+        elapsed = min(timeit.repeat(lambda: [fn(list(row)) for row in table], number=1, repeat=3))
+        print('{:15} {:12,.0f} rows/sec'.format(name, row_count / elapsed))
+
+
+if __name__ == '__main__':
+    main(*[int(i) for i in sys.argv[1:]])
@@ -0,0 +1,352 @@
+from __future__ import print_function
+from __future__ import absolute_import
+import os
+import io
+import bz2
+import csv
+import lzma
+import mmap
+import itertools
+import contextlib
+
+import tabulator
+from tabulator import helpers
+from tabulator.config import DEFAULT_BYTES_SAMPLE_SIZE
+
+
+def open_zstd(path):
+    """
+    Open a zstandard compressed file for reading.  The zstandard package is only needed if such a file is read.
+    """
+    import zstandard
+    return zstandard.open(path, 'rb')
+
+
+# Compression formats that tabulator doesn't read itself, by file extension.  Gzip and zip are handled by tabulator.
+decompressors = {
+    '.bz2': bz2.open,
+    '.xz': lzma.open,
+    '.lzma': lzma.open,
+    '.zst': open_zstd,
+}
+
+
+# Extensions of all of the compressed files that can be read, including the ones tabulator decompresses itself.
+compression_extensions = ['.gz', '.zip'] + list(decompressors)
+
+
+def source_name(source):
+    """
+    Get the name of a table source file without its directory, compression extension or format extension.
+    :param source: path to the file
+    :return: name such as 'table' for 'data/table.csv.gz'
+    """
+    name, extension = os.path.splitext(os.path.basename(source))
+    if extension.lower() in compression_extensions:
+        name = os.path.splitext(name)[0]
+    return name
+
+
+def source_format(source):
+    """
+    Get the format extension of a table source file, ignoring any compression extension.
+    :param source: path to the file
+    :return: extension such as '.csv' for 'data/table.csv.gz'
+    """
+    name, extension = os.path.splitext(os.path.basename(source))
+    if extension.lower() in compression_extensions:
+        extension = os.path.splitext(name)[1]
+    return extension.lower()
+
+
+def source_compression(source):
+    """
+    Get the extension of a source that is compressed in a format read with one of the decompressors.
+    :param source: table source
+    :return: file extension such as '.bz2', or None if the source isn't compressed in one of these formats.
+    """
+    if not isinstance(source, str):
+        return None
+    extension = os.path.splitext(source)[1].lower()
+    return extension if extension in decompressors else None
+
+
+class DecompressingLoader(tabulator.Loader):
+    """
+    Tabulator loader that decompresses a local file as it is read, so that the uncompressed data is never written to
+    disk.
+    """
+    options = []
+
+    def __init__(self, bytes_sample_size=DEFAULT_BYTES_SAMPLE_SIZE):
+        self.__bytes_sample_size = bytes_sample_size
+        self.__stats = None
+
+    def attach_stats(self, stats):
+        self.__stats = stats
+
+    def load(self, source, mode='t', encoding=None):
+        if source.startswith('file://'):
+            source = source.replace('file://', '', 1)
+        opener = decompressors[source_compression(source)]
+        try:
+            if mode == 't' and self.__bytes_sample_size:
+                # Not all of the decompressors can seek backwards, so the sample is read from its own stream.
+                with opener(source) as stream:
+                    encoding = helpers.detect_encoding(stream.read(self.__bytes_sample_size), encoding)
+            stream = opener(source)
+        except (IOError, EOFError, lzma.LZMAError) as exception:
+            raise tabulator.exceptions.LoadingError(str(exception))
+        if self.__stats:
+            stream = helpers.BytesStatsWrapper(stream, self.__stats)
+        if mode == 'b':
+            return stream
+        return io.TextIOWrapper(stream, encoding)
+
+
+def stream_options(source):
+    """
+    Get the tabulator Stream options needed to read a source.  Sources compressed with one of the decompressors are
+    read through a DecompressingLoader, with their format taken from the name without the compression extension.
+    :param source: table source
+    :return: dictionary of Stream options, which is empty for sources that tabulator reads itself.
+    """
+    compression = source_compression(source)
+    if compression is None:
+        return {}
+    inner_format = os.path.splitext(source[:-len(compression)])[1].lower().lstrip('.') or 'csv'
+    return {'format': inner_format, 'custom_loaders': {'file': DecompressingLoader}}
+
+
+def map_file(source):
+    """
+    Map a local file into memory for reading.  The mapping stays valid after the file is closed, so it can be shared
+    by every pass that reads the file.
+    :param source: path to the file
+    :return: read only mmap of the file, or an empty bytes object for an empty file, which can't be mapped.
+    """
+    with open(source, 'rb') as stream:
+        if os.fstat(stream.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+@contextlib.contextmanager
+def mapped(source, buffer=None):
+    """
+    Context manager for reading a local file through a memory map.
+    :param source: path to the file
+    :param buffer: an existing mapping of the file to use.  It is left open on exit.
+    :return: context manager whose value is the mapped file
+    """
+    if buffer is not None:
+        yield buffer
+        return
+    buffer = map_file(source)
+    try:
+        yield buffer
+    finally:
+        if isinstance(buffer, mmap.mmap):
+            buffer.close()
+
+
+def local_csv(source):
+    """
+    Check to see if a table source is an uncompressed CSV file on the local file system, which can be read starting at
+    an arbitrary byte offset.
+    :param source: table source
+    :return: True or False
+    """
+    if not (isinstance(source, str) and os.path.isfile(source)):
+        return False
+    try:
+        with tabulator.Stream(source, headers=1) as stream:
+            return stream.format == 'csv' and stream.compression == 'no' and stream.scheme == 'file'
+    except tabulator.exceptions.TabulatorException:
+        return False
+
+
+def source_dialect(source):
+    """
+    Get the CSV dialect and encoding that tabulator detects for a source, so that rows read directly from the file
+    are split the same way that tabulator would split them.
+    :param source: table source
+    :return: dictionary of csv.reader arguments and the encoding of the file
+    """
+    with tabulator.Stream(source, headers=1) as stream:
+        dialect = stream.dialect or {}
+        encoding = stream.encoding
+    reader_args = {
+        'delimiter': dialect.get('delimiter', ','),
+        'doublequote': dialect.get('doubleQuote', True),
+        'quotechar': dialect.get('quoteChar', '"'),
+        'skipinitialspace': dialect.get('skipInitialSpace', False),
+    }
+    if 'escapeChar' in dialect:
+        reader_args['escapechar'] = dialect['escapeChar']
+    return reader_args, encoding
+
+
+def record_lines(buffer, start, end, quotechar='"'):
+    """
+    Split the lines of a mapped file that belong to the records that start in the byte range [start, end).  Reading
+    starts at the first record boundary at or after start.  A record that starts before end is read to completion.
+    Quoted values with embedded newlines are followed by counting quote characters, so the range has to start on a
+    record boundary if such values can occur at its start.  Lines are found by searching the buffer, so no file
+    position is shared between readers of the same buffer.
+    :param buffer: mmap or bytes holding the file
+    :param start: byte offset where reading begins
+    :param end: byte offset where reading ends, or None to read to the end of the file
+    :param quotechar: quote character used in the file
+    :return: generator of (offset, line) tuples for the first line of each record and its continuation lines.
+    """
+    quote = quotechar.encode() if quotechar else None
+    size = len(buffer)
+    position = start
+    if start > 0:
+        # Look from one byte back, so that if start is already at the beginning of a line we don't skip that line.
+        newline = buffer.find(b'\n', start - 1)
+        position = size if newline < 0 else newline + 1
+    in_quote = False
+    while position < size:
+        if not in_quote and end is not None and position >= end:
+            return
+        newline = buffer.find(b'\n', position)
+        next_position = size if newline < 0 else newline + 1
+        line = buffer[position:next_position]
+        yield position, line
+        position = next_position
+        if quote and line.count(quote) % 2 == 1:
+            in_quote = not in_quote
+
+
+def record_blocks(buffer, start, end, quotechar='"', block_size=1 << 20):
+    """
+    Split the records that start in the byte range [start, end) of a mapped file into blocks of whole records, so
+    that each block can be decoded and parsed at once rather than a line at a time.  Records are found as in
+    record_lines, by counting quote characters from a record boundary.
+    :param buffer: mmap or bytes holding the file
+    :param start: byte offset where reading begins
+    :param end: byte offset where reading ends, or None to read to the end of the file
+    :param quotechar: quote character used in the file
+    :param block_size: approximate number of bytes in each block
+    :return: generator of (offset, block) tuples
+    """
+    quote = quotechar.encode() if quotechar else None
+    size = len(buffer)
+    end = size if end is None else min(end, size)
+    position = start
+    if start > 0:
+        newline = buffer.find(b'\n', start - 1)
+        position = size if newline < 0 else newline + 1
+    while position < end:
+        # Finish the line that contains the end of the block, then keep going while the block ends inside a quote.
+        newline = buffer.find(b'\n', min(position + block_size, end) - 1)
+        block_end = size if newline < 0 else newline + 1
+        quotes = buffer[position:block_end].count(quote) if quote else 0
+        while quotes % 2 == 1 and block_end < size:
+            newline = buffer.find(b'\n', block_end)
+            line_end = size if newline < 0 else newline + 1
+            quotes += buffer[block_end:line_end].count(quote)
+            block_end = line_end
+        yield position, buffer[position:block_end]
+        position = block_end
+
+
+def read_rows(source, start=0, end=None, dialect=None, encoding=None, buffer=None):
+    """
+    Read the rows of a local CSV file whose records start in the byte range [start, end).  The header row is skipped
+    if it is in the range.
+    :param source: path to the CSV file
+    :param start: byte offset where reading begins
+    :param end: byte offset where reading ends, or None to read to the end of the file
+    :param dialect: csv.reader arguments.  Detected from the source if not provided.
+    :param encoding: encoding of the file. Detected from the source if not provided.
+    :param buffer: existing mapping of the file, from map_file.  The file is mapped while it is read if not provided.
+    :return: generator of rows as lists of strings
+    """
+    if dialect is None or encoding is None:
+        dialect, encoding = source_dialect(source)
+    with mapped(source, buffer) as buffer:
+        blocks = record_blocks(buffer, start, end, dialect.get('quotechar'))
+        # Universal newlines, as tabulator reads files in text mode, so line breaks inside quoted values become '\n'.
+        lines = itertools.chain.from_iterable(io.StringIO(block.decode(encoding), newline=None)
+                                              for _, block in blocks)
+        reader = csv.reader(lines, **dialect)
+        if start == 0:
+            next(reader, None)
+        for row in reader:
+            yield row
+
+
+def sample_blocks(source, block_size, dialect=None, encoding=None, buffer=None):
+    """
+    Read blocks of rows from the head, middle and tail of a local CSV file without reading the rest of the file.
+    :param source: path to the CSV file
+    :param block_size: number of rows in each block
+    :param dialect: csv.reader arguments.  Detected from the source if not provided.
+    :param encoding: encoding of the file. Detected from the source if not provided.
+    :param buffer: existing mapping of the file, from map_file.
+    :return: list of rows
+    """
+    if dialect is None or encoding is None:
+        dialect, encoding = source_dialect(source)
+
+    with mapped(source, buffer) as buffer:
+        size = len(buffer)
+        head_bytes = sum(len(line) for _, line in itertools.islice(record_lines(buffer, 0, None), block_size + 1))
+        if head_bytes >= size:
+            # The whole file fits in the first block.
+            return list(read_rows(source, dialect=dialect, encoding=encoding, buffer=buffer))
+
+        # Use the size of the head block to estimate where the middle and tail blocks start.
+        tail_start = max(head_bytes, size - head_bytes)
+        middle_start = max(head_bytes, (size - head_bytes) // 2)
+        rows = list(read_rows(source, 0, head_bytes, dialect=dialect, encoding=encoding, buffer=buffer))
+        if middle_start < tail_start:
+            rows.extend(itertools.islice(read_rows(source, middle_start, tail_start, dialect=dialect,
+                                                   encoding=encoding, buffer=buffer), block_size))
+        rows.extend(read_rows(source, tail_start, None, dialect=dialect, encoding=encoding, buffer=buffer))
+    return rows
+
+
+def partition(source, parts, quotechar='"', block_size=1 << 20, buffer=None):
+    """
+    Split a local CSV file into byte ranges of about the same size, each starting on a record boundary.  Quote
+    characters are counted from the start of the file, so a newline inside a quoted value is never used as a boundary.
+    :param source: path to the CSV file
+    :param parts: number of ranges to split the file into
+    :param quotechar: quote character used in the file
+    :param block_size: number of bytes counted at a time while counting quotes
+    :param buffer: existing mapping of the file, from map_file.
+    :return: list of (start, end) byte offsets that cover the file
+    """
+    quote = quotechar.encode() if quotechar else b''
+    boundaries = [0]
+    with mapped(source, buffer) as buffer:
+        size = len(buffer)
+        in_quote = False
+        position = 0
+        for target in (size * i // parts for i in range(1, parts)):
+            if target <= position:
+                continue
+            # Keep track of the quote state up to the target offset.
+            while position < target:
+                block_end = min(position + block_size, target)
+                if quote:
+                    in_quote ^= buffer[position:block_end].count(quote) % 2 == 1
+                position = block_end
+            # Now find the end of the record that contains the target.
+            while position < size:
+                newline = buffer.find(b'\n', position)
+                line_end = size if newline < 0 else newline + 1
+                if quote:
+                    in_quote ^= buffer[position:line_end].count(quote) % 2 == 1
+                position = line_end
+                if not in_quote:
+                    break
+            if position >= size:
+                break
+            boundaries.append(position)
+    boundaries.append(size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
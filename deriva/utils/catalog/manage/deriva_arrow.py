@@ -0,0 +1,194 @@
+from __future__ import print_function
+from __future__ import absolute_import
+import os
+import base64
+import datetime
+import decimal
+
+import pyarrow as pa
+import pyarrow.ipc
+import pyarrow.parquet as pq
+from tableschema import Schema
+
+from deriva.utils.catalog.manage.deriva_csv import DerivaCSV, DerivaCSVError, RowValidator, parquet_extensions, \
+    columnar_extensions
+
+
+def is_arrow_source(source):
+    """
+    Check to see if a table source is a file in one of the columnar formats read by DerivaArrow.
+    :param source: table source
+    :return: True or False
+    """
+    return isinstance(source, str) and os.path.splitext(source)[1].lower() in columnar_extensions
+
+
+def arrow_field_type(arrow_type):
+    """
+    Map an Arrow type into a TableSchema type and format, and the ermrest type to use for the column.
+    :param arrow_type: pyarrow DataType
+    :return: tuple of TableSchema type, TableSchema format and ermrest type
+    """
+    types = pa.types
+    if types.is_dictionary(arrow_type):
+        return arrow_field_type(arrow_type.value_type)
+    if types.is_boolean(arrow_type):
+        return 'boolean', 'default', 'boolean'
+    if types.is_int8(arrow_type) or types.is_int16(arrow_type) or types.is_uint8(arrow_type):
+        return 'integer', 'default', 'int2'
+    if types.is_int32(arrow_type) or types.is_uint16(arrow_type):
+        return 'integer', 'default', 'int4'
+    if types.is_integer(arrow_type):
+        return 'integer', 'default', 'int8'
+    if types.is_float16(arrow_type) or types.is_float32(arrow_type):
+        return 'number', 'default', 'float4'
+    if types.is_floating(arrow_type) or types.is_decimal(arrow_type):
+        return 'number', 'default', 'float8'
+    if types.is_date(arrow_type):
+        return 'date', 'default', 'date'
+    if types.is_timestamp(arrow_type):
+        return 'datetime', 'default', 'timestamptz' if arrow_type.tz else 'timestamp'
+    if types.is_binary(arrow_type) or types.is_large_binary(arrow_type) or types.is_fixed_size_binary(arrow_type):
+        return 'string', 'binary', 'text'
+    if types.is_list(arrow_type) or types.is_large_list(arrow_type):
+        return 'array', 'default', 'jsonb'
+    if types.is_struct(arrow_type) or types.is_map(arrow_type):
+        return 'object', 'default', 'jsonb'
+    # Strings and anything else, such as times, are uploaded as text.
+    return 'string', 'default', 'text'
+
+
+def json_value(value):
+    """
+    Convert a value read from an Arrow table into a value that can be sent to ermrest as JSON.
+    """
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode('ascii')
+    if isinstance(value, datetime.timedelta):
+        return str(value)
+    if isinstance(value, (list, tuple)):
+        return [json_value(v) for v in value]
+    if isinstance(value, dict):
+        return {k: json_value(v) for k, v in value.items()}
+    return value
+
+
+class DerivaArrow(DerivaCSV):
+    """
+    A DerivaCSV whose source is a Parquet, Arrow or Feather file.  Column types are taken from the schema in the file
+    rather than inferred, and rows are read a record batch at a time and inserted without being parsed from text.
+    """
+    typed_source = True
+
+    def __init__(self, source, schema_name, table_name=None, column_map=True,
+                 key_columns=None, row_number_as_key=False, batch_size=10000):
+        """
+
+        :param source: Parquet, Arrow or Feather file containing the table data
+        :param schema_name: Name of the Deriva Schema in which this table will be located
+        :param table_name: Name of the table.  If not provided, use the source file name
+        :param column_map: a column name mapping dictionary. See DerivaCSV.
+        :param key_columns: name of columns to use as keys (non-null, unique). See DerivaCSV.
+        :param row_number_as_key: if key column is not provided, use the row number in the file in combination with a
+                            upload ID generated by system to identify the row.
+        :param batch_size: Number of rows read from the file at a time.
+        """
+        if not is_arrow_source(source):
+            raise DerivaCSVError(msg='Unknown columnar file type: {}'.format(source))
+        self.batch_size = batch_size
+        self._parquet = os.path.splitext(source)[1].lower() in parquet_extensions
+        if self._parquet:
+            parquet_file = pq.ParquetFile(source)
+            self.arrow_schema = parquet_file.schema_arrow
+            self._num_rows = parquet_file.metadata.num_rows
+        else:
+            with pa.memory_map(source) as stream:
+                reader = pa.ipc.open_file(stream)
+                self.arrow_schema = reader.schema
+                self._num_rows = sum(reader.get_batch(i).num_rows for i in range(reader.num_record_batches))
+
+        fields = []
+        for field in self.arrow_schema:
+            field_type, field_format, ermrest_type = arrow_field_type(field.type)
+            fields.append({'name': field.name, 'type': field_type, 'format': field_format,
+                           'ermrestType': ermrest_type})
+        super(DerivaArrow, self).__init__(source, schema_name, table_name=table_name, column_map=column_map,
+                                          key_columns=key_columns, row_number_as_key=row_number_as_key,
+                                          schema={'fields': fields})
+        self.row_count = self._num_rows
+
+    @property
+    def headers(self):
+        return self.arrow_schema.names
+
+    def _load_headers(self):
+        # The headers and schema come from the file, so there is nothing to read.
+        pass
+
+    def _batches(self):
+        if self._parquet:
+            for batch in pq.ParquetFile(self.source).iter_batches(batch_size=self.batch_size):
+                yield batch
+        else:
+            with pa.memory_map(self.source) as stream:
+                reader = pa.ipc.open_file(stream)
+                for i in range(reader.num_record_batches):
+                    yield reader.get_batch(i)
+
+    def _source_rows(self):
+        row_number = 1  # Count rows as if there were a header, like a CSV file.
+        for batch in self._batches():
+            columns = [[json_value(v) for v in column.to_pylist()] for column in batch.columns]
+            for row in zip(*columns):
+                row_number += 1
+                yield row_number, list(row)
+
+    def _catalog_rows(self, headers, post_parse):
+        extended_rows = ((row_number, headers, row) for row_number, row in self._source_rows())
+        for _, row_headers, row in post_parse(extended_rows):
+            yield dict(zip(row_headers, row))
+
+    @staticmethod
+    def _row_converter(field_types):
+        # Values already have the right python type.
+        return list
+
+    def infer(self, *args, **kwargs):
+        """
+        Column types are taken from the file, so there is nothing to infer.
+        """
+        self.row_count = self._num_rows
+        self.type_confidence = {header: 1.0 for header in self.headers}
+
+    def validate(self, catalog, validation_limit=None, processes=1, model=None):
+        """
+        Validate the contents of the table against an existing table in a catalog.  Values already have a type, so
+        this checks the headers, that required columns have values and that keys are unique.
+        :param catalog: Ermrest catalog
+        :param validation_limit: Number of rows to check. Defaults to the entire table.
+        :param processes: Ignored.
+        :param model: catalog model to use rather than fetching it from the catalog.
+        :return: True if the table is valid, and the validation report
+        """
+        table_schema = self.table_schema_from_catalog(catalog, model=model)
+        descriptor = table_schema.descriptor
+        if self.row_number_as_key:
+            # The upload id and row number are not in the source.
+            del descriptor['primaryKey']
+            descriptor['fields'] = descriptor['fields'][2:]
+        validator = RowValidator(Schema(descriptor), self.source, check_types=False)
+
+        field_names = [f.name for f in validator.fields]
+        for index, header in enumerate(self.map_names(self.headers)):
+            if header not in field_names:
+                validator.error('non-matching-header', 1, index + 1, header=header)
+        for row_number, row in self._source_rows():
+            if validation_limit is not None and row_number > validation_limit + 1:
+                break
+            validator(row_number, row)
+        self.validation_report = validator.report(self.headers)
+        return self.validation_report['valid'], self.validation_report
@@ -2,20 +2,29 @@ from __future__ import print_function
 
 import argparse
 import ast
+import contextlib
+import hashlib
+import json
 import logging
 import os
+import pprint
 import re
 import sys
+from concurrent.futures import ProcessPoolExecutor
 
+from yapf import __version__ as yapf_version
 from yapf.yapflib.yapf_api import FormatCode
 
 from attrdict import AttrDict
 from deriva.core import ErmrestCatalog, get_credential
+import deriva.core.ermrest_model as em
 
 from deriva.core.ermrest_config import tag as chaise_tags
 from deriva.utils.catalog.manage.deriva_file_templates import table_file_template, schema_file_template, \
     catalog_file_template
 from deriva.utils.catalog.manage.graph_catalog import DerivaCatalogToGraph
+from deriva.utils.catalog.manage.utils import LoopbackCatalog, SnapshotCatalog, catalog_group_entities, \
+    save_catalog_snapshot
 
 IS_PY2 = (sys.version_info[0] == 2)
 IS_PY3 = (sys.version_info[0] == 3)
@@ -38,42 +47,213 @@ yapf_style = {
     'column_limit': 100
 }
 
+# Ways of laying out the generated code.  yapf reformats the code, pprint lays it out as it is generated, which is
+# much faster.
+formatters = ['yapf', 'pprint']
+
+# Name of the file in the dump directory that records what each file was rendered from.
+manifest_filename = 'dump_manifest.json'
+
+
+def canonical_hash(value):
+    """
+    Hash a JSON value so that equal values have the same hash no matter what order their keys are in.
+    :param value: value that can be converted to JSON
+    :return: hex digest
+    """
+    s = json.dumps(value, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(s.encode('utf-8')).hexdigest()
+
+
+def yapf_format(s, cache_dir=None):
+    """
+    Format code with yapf using yapf_style.  If a cache directory is given, the formatted code is saved there, keyed by
+    a hash of the code, the style and the yapf version, so code that has been formatted before isn't formatted again.
+    :param s: code to format
+    :param cache_dir: directory in which to keep formatted code
+    :return: formatted code
+    """
+    if cache_dir is None:
+        return FormatCode(s, style_config=yapf_style)[0]
+
+    key = canonical_hash([yapf_version, yapf_style, s])
+    filename = os.path.join(cache_dir, key[:2], key + '.py')
+    try:
+        with open(filename) as f:
+            return f.read()
+    except (OSError, IOError):
+        pass
+    formatted = FormatCode(s, style_config=yapf_style)[0]
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    # Write under a unique name and rename, so processes filling the cache at the same time can't see a partial file.
+    tmpfile = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(tmpfile, 'w') as f:
+        f.write(formatted)
+    os.replace(tmpfile, filename)
+    return formatted
+
+
+def pprint_format(s):
+    """
+    Tidy code whose values were laid out with pprint: strip trailing blanks and keep at most two blank lines in a row.
+    """
+    s = re.sub(r'[ \t]+\n', '\n', s)
+    return re.sub(r'\n{4,}', '\n\n\n', s).strip('\n') + '\n'
+
+
+def element_filename(schema_name, table_name=None):
+    """
+    Name of the dump file for a schema, or a table if a table name is given, relative to the dump directory.
+    """
+    if table_name is None:
+        return '{}.schema.py'.format(schema_name)
+    return '{}/{}.py'.format(schema_name, table_name)
+
+
+def dump_manifest(model_doc, server, catalog_id, groups, provide_system_columns=True, skip_schemas=None,
+                  formatter='yapf'):
+    """
+    Compute the manifest of a catalog dump, which has a hash of the model element each file is rendered from, and a
+    hash of the settings that all of the files depend on.
+    :param model_doc: the /schema document of the catalog
+    :param server: server name
+    :param catalog_id: catalog id
+    :param groups: dictionary of group names and IDs used when rendering
+    :param provide_system_columns: value used when rendering
+    :param skip_schemas: schemas whose schema file is not dumped
+    :param formatter: formatter used when rendering
+    :return: dictionary with the settings hash and a map from file name to element hash
+    """
+    files = {
+        '{}_{}.py'.format(server, catalog_id): canonical_hash({k: model_doc.get(k) for k in ['annotations', 'acls']})
+    }
+    for schema_name, schema_doc in model_doc['schemas'].items():
+        if skip_schemas is None or schema_name not in skip_schemas:
+            schema_element = {k: v for k, v in schema_doc.items() if k != 'tables'}
+            # The schema file lists the tables in order.
+            schema_element['table_names'] = list(schema_doc['tables'])
+            files[element_filename(schema_name)] = canonical_hash(schema_element)
+        for table_name, table_doc in schema_doc['tables'].items():
+            files[element_filename(schema_name, table_name)] = canonical_hash(table_doc)
+
+    settings = canonical_hash({
+        'server': server, 'catalog_id': str(catalog_id), 'groups': dict(groups),
+        'provide_system_columns': provide_system_columns, 'formatter': formatter, 'yapf_style': yapf_style,
+        'templates': [catalog_file_template, schema_file_template, table_file_template]
+    })
+    return {'settings': settings, 'files': files}
+
+
+def read_manifest(dumpdir):
+    """
+    Read the manifest left in a dump directory by a previous dump.
+    :return: the manifest, or an empty dictionary if there isn't a readable one.
+    """
+    try:
+        with open(os.path.join(dumpdir, manifest_filename)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return manifest if isinstance(manifest, dict) else {}
+
+
+def write_manifest(dumpdir, manifest):
+    filename = os.path.join(dumpdir, manifest_filename)
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(filename + '.tmp', filename)
+
+
+def changed_files(previous, manifest, dumpdir, model_doc=None):
+    """
+    Compare the manifest of a dump with the one from the previous dump of the directory.  The files of schemas that
+    weren't dumped because of skip_schemas are left alone, and their entries are carried over into the manifest.
+    :param model_doc: the /schema document the manifest was computed from.  If not given, every file that isn't in
+                      the manifest is dropped.
+    :return: set of the files that have to be rendered again, and list of the files of elements that were dropped.
+    """
+    files = manifest['files']
+    previous_files = previous.get('files', {}) if previous.get('settings') == manifest['settings'] else {}
+    changed = {f for f, h in files.items()
+               if previous_files.get(f) != h or not os.path.exists(os.path.join(dumpdir, f))}
+    # Schemas that are still in the catalog, whether or not their files were dumped this time.
+    schema_files = set() if model_doc is None else {element_filename(i) for i in model_doc['schemas']}
+    files.update((f, h) for f, h in previous_files.items() if f in schema_files and f not in files)
+    dropped = sorted(f for f in previous.get('files', {}) if f not in files and f not in schema_files)
+    return changed, dropped
+
 
 class DerivaCatalogToString:
-    def __init__(self, catalog, provide_system_columns=True, groups=None):
+    def __init__(self, catalog, provide_system_columns=True, groups=None, model=None, formatter='yapf',
+                 format_cache=None):
+        """
+
+        :param catalog: catalog to render
+        :param provide_system_columns: value of provide_system in the generated table definitions
+        :param groups: dictionary of group names and IDs.  If not provided, read the ERMrest_Group table.
+        :param model: catalog model to use rather than fetching it from the catalog.
+        :param formatter: yapf to format the generated code with yapf, or pprint to lay out values with pprint.
+        :param format_cache: directory in which to keep code formatted by yapf.
+        """
+        if formatter not in formatters:
+            raise ValueError('Unknown formatter: {}'.format(formatter))
         self._catalog = catalog
-        self._model = catalog.getCatalogModel()
+        self._model = catalog.getCatalogModel() if model is None else model
         self._provide_system_columns = provide_system_columns
+        self._formatter = formatter
+        self._format_cache = format_cache
         # Get the currently known groups for this catalog.
         self._groups = groups
         if groups is None:
-            self._groups = AttrDict(
-                {e['Display_Name']: e['ID'] for e in catalog.getPathBuilder().public.ERMrest_Group.entities()}
-            )
+            self._groups = AttrDict({e['Display_Name']: e['ID'] for e in catalog_group_entities(catalog)})
 
         self._referenced_groups = {}
         self._variables = self._groups.copy()
         self._variables.update(chaise_tags)
 
-    def substitute_variables(self, code):
-        """
-        Factor out code and replace with a variable name.
-        :param code:
-        :return: new code
-        """
+        # Map each quoted value to the variable that replaces it, and match all of the values with one pattern so a
+        # string is substituted in a single scan.  If two variables have the same value, the first one is used.
+        self._substitutions = {}
         for k, v in self._variables.items():
-            varsub = r"(['\"])+{}\1".format(v)
             if k in chaise_tags:
                 repl = 'chaise_tags.{}'.format(k)
             elif k in self._groups:
                 repl = 'groups[{!r}]'.format(k)
-                if v in code:
-                    self._referenced_groups[k] = v
             else:
                 repl = k
-            code = re.sub(varsub, repl, code)
+            self._substitutions.setdefault(str(v), (k, repl))
+        self._variable_pattern = re.compile(r"(['\"])+({})\1".format(
+            '|'.join(re.escape(v) for v in sorted(self._substitutions, key=len, reverse=True))))
+
+    def substitute_variables(self, code):
+        """
+        Factor out code and replace with a variable name.
+        :param code:
+        :return: new code
+        """
+        def replace(match):
+            k, repl = self._substitutions[match.group(2)]
+            if k in self._groups and k not in chaise_tags:
+                self._referenced_groups[k] = self._variables[k]
+            return repl
+
+        return self._variable_pattern.sub(replace, code)
 
-        return code
+    @contextlib.contextmanager
+    def file_groups(self):
+        """
+        Collect the groups referenced while a single file is rendered, so that a file declares the groups it uses no
+        matter which files were rendered before it.  When the file is done, its groups are added to the groups
+        referenced so far.
+        :return: dictionary of the groups referenced by the file
+        """
+        referenced_groups = self._referenced_groups
+        self._referenced_groups = {}
+        try:
+            yield self._referenced_groups
+        finally:
+            referenced_groups.update(self._referenced_groups)
+            self._referenced_groups = referenced_groups
 
     def variable_to_str(self, name, value, substitute=True):
         """
@@ -84,7 +264,13 @@ class DerivaCatalogToString:
         :return:
         """
 
-        s = '{} = {!r}\n'.format(name, value)
+        if self._formatter == 'pprint' and value:
+            # Line up continuation lines with the start of the value.
+            indent = len(name) + 3
+            lines = pprint.pformat(value, width=max(yapf_style['column_limit'] - indent, 40)).split('\n')
+            s = '{} = {}\n'.format(name, ('\n' + ' ' * indent).join(lines))
+        else:
+            s = '{} = {!r}\n'.format(name, value)
         if substitute:
             s = self.substitute_variables(s)
         return s
@@ -115,6 +301,14 @@ class DerivaCatalogToString:
         var_map = {v: k for k, v in self._variables.items()}
         if annotations == {}:
             s = '{} = {{}}\n'.format(var_name)
+        elif self._formatter == 'pprint':
+            s = '{} = {{\n'.format(var_name)
+            for t, v in annotations.items():
+                if t in var_map:
+                    s += self.substitute_variables('    {!r}: {},\n'.format(t, var_map[t]))
+                else:
+                    s += '    {!r}: {},\n'.format(t, '\n    '.join(pprint.pformat(v).split('\n')))
+            s += '}\n'
         else:
             s = '{} = {{'.format(var_name)
             for t, v in annotations.items():
@@ -131,32 +325,34 @@ class DerivaCatalogToString:
         server = urlparse(self._catalog.get_server_uri()).hostname
         catalog_id = self._catalog.get_server_uri().split('/')[-1]
 
-        annotations = self.variable_to_str('annotations', schema.annotations)
-        acls = self.variable_to_str('acls', schema.acls)
-        comments = self.variable_to_str('comment', schema.comment)
-        groups = self.variable_to_str('groups', self._referenced_groups, substitute=False)
+        with self.file_groups() as referenced_groups:
+            annotations = self.variable_to_str('annotations', schema.annotations)
+            acls = self.variable_to_str('acls', schema.acls)
+            comments = self.variable_to_str('comment', schema.comment)
+        groups = self.variable_to_str('groups', referenced_groups, substitute=False)
 
         s = schema_file_template.format(server=server, catalog_id=catalog_id, schema_name=schema_name,
                                         annotations=annotations, acls=acls, comments=comments, groups=groups,
                                         table_names='table_names = [\n{}]\n'.format(
                                             str.join('', ['{!r},\n'.format(i) for i in schema.tables])))
-        s = FormatCode(s, style_config=yapf_style)[0]
+        s = self.format_code(s)
         return s
 
     def catalog_to_str(self):
         server = urlparse(self._catalog.get_server_uri()).hostname
         catalog_id = self._catalog.get_server_uri().split('/')[-1]
 
-        tag_variables = self.tag_variables_to_str(self._model.annotations)
-        annotations = self.annotations_to_str(self._model.annotations)
-        acls = self.variable_to_str('acls', self._model.acls)
-        groups = self.variable_to_str('groups', self._referenced_groups, substitute=False)
+        with self.file_groups() as referenced_groups:
+            tag_variables = self.tag_variables_to_str(self._model.annotations)
+            annotations = self.annotations_to_str(self._model.annotations)
+            acls = self.variable_to_str('acls', self._model.acls)
+        groups = self.variable_to_str('groups', referenced_groups, substitute=False)
 
         s = catalog_file_template.format(server=server, catalog_id=catalog_id, groups=groups,
                                          tag_variables=tag_variables,
                                          annotations=annotations,
                                          acls=acls)
-        s = FormatCode(s, style_config=yapf_style)[0]
+        s = self.format_code(s)
         return s
 
     def table_annotations_to_str(self, table):
@@ -193,13 +389,13 @@ class DerivaCatalogToString:
     def foreign_key_defs_to_str(self, table):
         s = 'fkey_defs = [\n'
         for fkey in table.foreign_keys:
-            s += """    em.ForeignKey.define({},
-                '{}', '{}', {},
-                constraint_names={},\n""".format([c['column_name'] for c in fkey.foreign_key_columns],
-                                                 fkey.referenced_columns[0]['schema_name'],
-                                                 fkey.referenced_columns[0]['table_name'],
-                                                 [c['column_name'] for c in fkey.referenced_columns],
-                                                 fkey.names)
+            s += """    em.ForeignKey.define(
+        {}, '{}', '{}', {},
+        constraint_names={},\n""".format([c['column_name'] for c in fkey.foreign_key_columns],
+                                                fkey.referenced_columns[0]['schema_name'],
+                                                fkey.referenced_columns[0]['table_name'],
+                                                [c['column_name'] for c in fkey.referenced_columns],
+                                                fkey.names)
 
             for i in ['annotations', 'acls', 'acl_bindings', 'on_update', 'on_delete', 'comment']:
                 a = getattr(fkey, i)
@@ -215,14 +411,15 @@ class DerivaCatalogToString:
     def key_defs_to_str(self, table):
         s = 'key_defs = [\n'
         for key in table.keys:
-            s += """    em.Key.define({},
-                       constraint_names={},\n""".format(key.unique_columns, key.names)
+            s += """    em.Key.define(
+        {},
+        constraint_names={},\n""".format(key.unique_columns, key.names)
             for i in ['annotations', 'comment']:
                 a = getattr(key, i)
                 if not (a == {} or a is None or a == ''):
                     v = "'" + a + "'" if i == 'comment' else a
-                    s += "       {} = {},\n".format(i, v)
-            s += '),\n'
+                    s += "        {}={},\n".format(i, v)
+            s += '    ),\n'
         s += ']'
         s = self.substitute_variables(s)
         return s
@@ -230,35 +427,39 @@ class DerivaCatalogToString:
     def column_defs_to_str(self, table):
         system_columns = ['RID', 'RCB', 'RMB', 'RCT', 'RMT']
 
-        s = ['column_defs = [']
+        s = ['column_defs = [\n']
         for col in table.column_definitions:
             if col.name in system_columns and self._provide_system_columns:
                 continue
-            s.append('''    em.Column.define('{}', em.builtin_types['{}'],'''.
-                     format(col.name, col.type.typename + '[]' if 'is_array' is True else col.type.typename))
+            args = ["'{}',".format(col.name), "em.builtin_types['{}'],".format(
+                col.type.typename + '[]' if 'is_array' is True else col.type.typename)]
             if col.nullok is False:
-                s.append("nullok=False,")
+                args.append("nullok=False,")
             if col.default and col.name not in system_columns:
-                s.append("default={!r},".format(col.default))
+                args.append("default={!r},".format(col.default))
             for i in ['annotations', 'acls', 'acl_bindings', 'comment']:
                 colvar = getattr(col, i)
                 if colvar:  # if we have a value for this field....
-                    s.append("{}=column_{}['{}'],".format(i, i, col.name))
-            s.append('),\n')
+                    args.append("{}=column_{}['{}'],".format(i, i, col.name))
+            column_def = '    em.Column.define({}),\n'.format(' '.join(args))
+            if len(column_def) > yapf_style['column_limit']:
+                column_def = '    em.Column.define(\n{}    ),\n'.format(''.join('        {}\n'.format(a) for a in args))
+            s.append(column_def)
         s.append(']')
         return ''.join(s)
 
     def table_def_to_str(self):
-        s = """table_def = em.Table.define(table_name,
-        column_defs=column_defs,
-        key_defs=key_defs,
-        fkey_defs=fkey_defs,
-        annotations=table_annotations,
-        acls=table_acls,
-        acl_bindings=table_acl_bindings,
-        comment=table_comment,
-        provide_system = {}
-    )""".format(self._provide_system_columns)
+        s = """table_def = em.Table.define(
+    table_name,
+    column_defs=column_defs,
+    key_defs=key_defs,
+    fkey_defs=fkey_defs,
+    annotations=table_annotations,
+    acls=table_acls,
+    acl_bindings=table_acl_bindings,
+    comment=table_comment,
+    provide_system={}
+)""".format(self._provide_system_columns)
         return s
 
     def table_to_str(self, schema_name, table_name):
@@ -268,14 +469,14 @@ class DerivaCatalogToString:
         server = urlparse(self._catalog.get_server_uri()).hostname
         catalog_id = self._catalog.get_server_uri().split('/')[-1]
 
-
-        column_annotations = self.column_annotations_to_str(table)
-        column_defs = self.column_defs_to_str(table)
-        table_annotations = self.table_annotations_to_str(table)
-        key_defs = self.key_defs_to_str(table)
-        fkey_defs = self.foreign_key_defs_to_str(table)
+        with self.file_groups() as referenced_groups:
+            column_annotations = self.column_annotations_to_str(table)
+            column_defs = self.column_defs_to_str(table)
+            table_annotations = self.table_annotations_to_str(table)
+            key_defs = self.key_defs_to_str(table)
+            fkey_defs = self.foreign_key_defs_to_str(table)
         table_def = self.table_def_to_str()
-        groups = self.variable_to_str('groups', self._referenced_groups, substitute=False)
+        groups = self.variable_to_str('groups', referenced_groups, substitute=False)
 
         s = table_file_template.format(server=server, catalog_id=catalog_id,
                                        table_name=table_name, schema_name=schema_name, groups=groups,
@@ -285,9 +486,68 @@ class DerivaCatalogToString:
                                        key_defs=key_defs,
                                        fkey_defs=fkey_defs,
                                        table_def=table_def)
-        s = FormatCode(s, style_config=yapf_style)[0]
+        s = self.format_code(s)
         return s
 
+    def format_code(self, s):
+        """
+        Lay out generated code with the formatter for this DerivaCatalogToString.
+        """
+        if self._formatter == 'pprint':
+            return pprint_format(s)
+        return yapf_format(s, cache_dir=self._format_cache)
+
+    def element_to_str(self, schema_name, table_name=None):
+        """
+        Render the file for a schema, or for a table if a table name is given.
+        """
+        if table_name is None:
+            return self.schema_to_str(schema_name)
+        return self.table_to_str(schema_name, table_name)
+
+    def elements_to_str(self, elements, jobs=1):
+        """
+        Render the files for a list of schemas and tables.  If jobs is more than one, the files are rendered by a pool
+        of processes, each of which is sent a snapshot of the model and groups once, rather than one after another.
+        :param elements: list of (schema_name, table_name) tuples, where table_name is None for a schema file.
+        :param jobs: number of processes to use.
+        :return: generator of the rendered files, in the same order as elements.
+        """
+        if jobs <= 1:
+            for schema_name, table_name in elements:
+                yield self.element_to_str(schema_name, table_name)
+            return
+
+        # The model is sent as is, as prejson leaves out column ACLs.
+        snapshot = (self._model, dict(self._groups), self._catalog.get_server_uri(),
+                    self._provide_system_columns, self._formatter, self._format_cache)
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_dump_worker, initargs=snapshot) as executor:
+            futures = [executor.submit(_dump_worker_element_to_str, schema_name, table_name)
+                       for schema_name, table_name in elements]
+            for future in futures:
+                s, referenced_groups = future.result()
+                self._referenced_groups.update(referenced_groups)
+                yield s
+
+
+# DerivaCatalogToString used by a dump worker process, made from the model snapshot sent by elements_to_str.
+_dump_worker_stringer = None
+
+
+def _init_dump_worker(model, groups, server_uri, provide_system_columns, formatter, format_cache):
+    global _dump_worker_stringer
+    catalog = LoopbackCatalog(model, server_uri=server_uri)
+    _dump_worker_stringer = DerivaCatalogToString(catalog, provide_system_columns=provide_system_columns,
+                                                  groups=AttrDict(groups), formatter=formatter,
+                                                  format_cache=format_cache)
+
+
+def _dump_worker_element_to_str(schema_name, table_name):
+    # Return the groups referenced by this file so the parent can merge them.
+    with _dump_worker_stringer.file_groups() as referenced_groups:
+        s = _dump_worker_stringer.element_to_str(schema_name, table_name)
+    return s, referenced_groups
+
 
 def main():
     def python_value(s):
@@ -298,7 +558,7 @@ def main():
         return val
 
     parser = argparse.ArgumentParser(description='Dump definition for catalog {}:{}')
-    parser.add_argument('server', help='Catalog server name')
+    parser.add_argument('server', nargs='?', default=None, help='Catalog server name.  Not needed with --snapshot')
     parser.add_argument('--catalog-id', default=1, help='ID number of desired catalog')
     parser.add_argument('--dir', default="catalog-configs", help='output directory name)')
     parser.add_argument('--table', default=None, help='Only dump out the spec for the specified table.  Format is '
@@ -306,10 +566,24 @@ def main():
     parser.add_argument('--schemas', type=python_value, default=None, help='Only dump out the spec for the specified '
                                                                            'schemas (value or list).')
     parser.add_argument('--skip-schemas', type=python_value, default=None, help='List of schema so skip over')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='Number of processes to use to render the schema and table files')
+    parser.add_argument('--formatter', choices=formatters, default='yapf',
+                        help='Format the generated code with yapf, or lay it out with pprint, which is much faster')
+    parser.add_argument('--format-cache', default=None,
+                        help='Directory in which to keep code formatted by yapf, so it is not formatted again')
+    parser.add_argument('--full', action='store_true',
+                        help='Rewrite every file rather than only those whose part of the model has changed')
+    parser.add_argument('--snapshot', default=None, metavar='FILE',
+                        help='Read the catalog model and groups from a snapshot file rather than the server')
+    parser.add_argument('--save-snapshot', default=None, metavar='FILE',
+                        help='Save a snapshot of the catalog model and groups to a file and exit')
     parser.add_argument('--graph', action='store_true', help='Dump graph of catalog')
     parser.add_argument('--graph-format', choices=['pdf', 'dot', 'png', 'svg'],
                         default='pdf', help='Format to use for graph dump')
     args = parser.parse_args()
+    if args.server is None and args.snapshot is None:
+        parser.error('A server name is required unless a snapshot is used')
 
     dumpdir = args.dir
     server = args.server
@@ -322,15 +596,27 @@ def main():
     skip_schemas = args.skip_schemas
     skip_schemas = [skip_schemas] if skip_schemas is not None and type(skip_schemas) is str else skip_schemas
 
+    if args.snapshot is not None:
+        catalog = SnapshotCatalog(args.snapshot)
+        server = urlparse(catalog.get_server_uri()).hostname
+        catalog_id = catalog.get_server_uri().split('/')[-1]
+    else:
+        credential = get_credential(server)
+        catalog = ErmrestCatalog('https', server, catalog_id, credentials=credential)
+
+    if args.save_snapshot is not None:
+        save_catalog_snapshot(catalog, args.save_snapshot)
+        print('Saved snapshot of {} to {}'.format(catalog.get_server_uri(), args.save_snapshot))
+        return
+
     try:
         os.makedirs(dumpdir, exist_ok=True)
     except OSError:
         print("Creation of the directory %s failed" % dumpdir)
         sys.exit(1)
 
-    credential = get_credential(server)
-    catalog = ErmrestCatalog('https', server, catalog_id, credentials=credential)
-    model_root = catalog.getCatalogModel()
+    model_doc = catalog.get('/schema').json()
+    model_root = em.Model(model_doc)
 
     print('Catalog has {} schema and {} tables'.format(len(model_root.schemas),
                                                        sum([len(v.tables) for k, v in model_root.schemas.items()])))
@@ -339,7 +625,7 @@ def main():
 
     if table is not None:
         if ':' not in table:
-            if args.schema is not None and len(schemas) == 1:
+            if schemas is not None and len(schemas) == 1:
                 schema_name = schemas[0]
                 table_name = table
             else:
@@ -348,7 +634,7 @@ def main():
         else:
             [schema_name, table_name] = table.split(":")
         print("Dumping out table def....")
-        stringer = DerivaCatalogToString(catalog)
+        stringer = DerivaCatalogToString(catalog, formatter=args.formatter, format_cache=args.format_cache)
         table_string = stringer.table_to_str(schema_name, table_name)
         with open(table_name + '.py', 'w') as f:
             print(table_string, file=f)
@@ -356,32 +642,54 @@ def main():
         graph = DerivaCatalogToGraph(catalog)
         graphfile = '{}_{}'.format(server, catalog_id)
         graph.catalog_to_graph(skip_schemas=skip_schemas, schemas=schemas, skip_terms=True, skip_assocation_tables=True)
-        graph.save(filename=graphfile, format=args.graphformat)
+        graph.save(filename=graphfile, format=args.graph_format)
     else:
-        print("Dumping catalog def....")
-        stringer = DerivaCatalogToString(catalog)
-        catalog_string = stringer.catalog_to_str()
-
-        with open('{}/{}_{}.py'.format(dumpdir, server, catalog_id), 'w') as f:
-            print(catalog_string, file=f)
-
-        for schema_name in model_root.schemas:
-            if skip_schemas is not None and schema_name in skip_schemas:
-                continue
-            print("Dumping schema def for {}....".format(schema_name))
-            schema_string = stringer.schema_to_str(schema_name)
-
-            with open('{}/{}.schema.py'.format(dumpdir, schema_name), 'w') as f:
-                print(schema_string, file=f)
-
-        for schema_name, schema in model_root.schemas.items():
-            for i in schema.tables:
-                print('Dumping {}:{}'.format(schema_name, i))
-                table_string = stringer.table_to_str(schema_name, i)
-                filename = '{}/{}/{}.py'.format(dumpdir, schema_name, i)
-                os.makedirs(os.path.dirname(filename), exist_ok=True)
-                with open(filename, 'w') as f:
-                    print(table_string, file=f)
+        stringer = DerivaCatalogToString(catalog, model=model_root, formatter=args.formatter,
+                                         format_cache=args.format_cache)
+        manifest = dump_manifest(model_doc, server, catalog_id, stringer._groups, skip_schemas=skip_schemas,
+                                 formatter=args.formatter)
+        # Only render the files whose part of the model has changed since the last dump.
+        changed, dropped = changed_files({} if args.full else read_manifest(dumpdir), manifest, dumpdir,
+                                         model_doc)
+
+        catalog_filename = '{}_{}.py'.format(server, catalog_id)
+        if catalog_filename in changed:
+            print("Dumping catalog def....")
+            catalog_string = stringer.catalog_to_str()
+            with open('{}/{}'.format(dumpdir, catalog_filename), 'w') as f:
+                print(catalog_string, file=f)
+
+        elements = [(schema_name, None) for schema_name in model_root.schemas
+                    if skip_schemas is None or schema_name not in skip_schemas]
+        elements.extend((schema_name, i) for schema_name, schema in model_root.schemas.items() for i in schema.tables)
+        elements = [e for e in elements if element_filename(*e) in changed]
+
+        for (schema_name, table_name), element_string in zip(elements, stringer.elements_to_str(elements, args.jobs)):
+            if table_name is None:
+                print("Dumping schema def for {}....".format(schema_name))
+            else:
+                print('Dumping {}:{}'.format(schema_name, table_name))
+            filename = '{}/{}'.format(dumpdir, element_filename(schema_name, table_name))
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(filename, 'w') as f:
+                print(element_string, file=f)
+
+        for filename in dropped:
+            print('Removing {}'.format(filename))
+            try:
+                os.remove('{}/{}'.format(dumpdir, filename))
+            except OSError:
+                pass
+            if os.path.dirname(filename):
+                try:
+                    os.rmdir('{}/{}'.format(dumpdir, os.path.dirname(filename)))
+                except OSError:
+                    # There are still tables in the schema.
+                    pass
+
+        # Written last, so that if the dump is interrupted the next one renders anything that was missed.
+        write_manifest(dumpdir, manifest)
+        print('Wrote {} of {} files, removed {}'.format(len(changed), len(manifest['files']), len(dropped)))
 
 
 if __name__ == "__main__":
@@ -1,6 +1,16 @@
+import os
+import copy
+import gzip
+import json
 import random
 import datetime
 import string
+import hashlib
+import heapq
+import itertools
+import pickle
+import tempfile
+from array import array
 
 from deriva.core.ermrest_catalog import ErmrestCatalog
 import deriva.core.ermrest_model as em
@@ -22,15 +32,18 @@ class LoopbackCatalog:
         def json(self):
             return self._val
 
-    def __init__(self, model=None):
+    def __init__(self, model=None, server_uri=None):
         self._server = 'host.local'
         self._catalog_id = 1
+        self._server_uri = server_uri
 
         self._model = model
         if self._model is None:
             self._model = em.Model({})
 
     def get_server_uri(self):
+        if self._server_uri is not None:
+            return self._server_uri
         return 'http://{}/ermrest/{}'.format(self._server, self._catalog_id)
 
     def getCatalogModel(self):
@@ -42,6 +55,9 @@ class LoopbackCatalog:
     def get(self, uri):
         if uri == '/schema':
             return LoopbackCatalog.LoopbackResult(uri, json=self._model.schemas)
+        if uri == '/':
+            # There is no snaptime, as the model can be changed without the catalog knowing.
+            return LoopbackCatalog.LoopbackResult(uri, json={})
 
     def put(self, uri, json=None, data=None):
         pass
@@ -50,6 +66,67 @@ class LoopbackCatalog:
         pass
 
 
+class SnapshotCatalog(LoopbackCatalog):
+    """
+    Catalog that serves the model and groups saved by save_catalog_snapshot, so that tools which only read a catalog
+    can be run without a server.
+    """
+
+    def __init__(self, filename):
+        """
+
+        :param filename: snapshot file written by save_catalog_snapshot
+        """
+        with gzip.open(filename, 'rt', encoding='utf-8') as f:
+            snapshot = json.load(f)
+        self.snaptime = snapshot.get('snaptime')
+        self.group_entities = snapshot['groups']
+        self._schema_doc = snapshot['schema']
+        super(SnapshotCatalog, self).__init__(em.Model(copy.deepcopy(self._schema_doc)),
+                                              server_uri=snapshot['server_uri'])
+
+    def get(self, uri):
+        if uri == '/schema':
+            return LoopbackCatalog.LoopbackResult(uri, json=copy.deepcopy(self._schema_doc))
+        if uri == '/':
+            # The snapshot never changes, so it keeps the snaptime of the catalog it was taken from.
+            return LoopbackCatalog.LoopbackResult(uri, json={'snaptime': self.snaptime})
+        return super(SnapshotCatalog, self).get(uri)
+
+
+def catalog_group_entities(catalog):
+    """
+    Get the entities in the ERMrest_Group table of a catalog, or the ones saved in a catalog snapshot.
+    :param catalog: ErmrestCatalog or SnapshotCatalog
+    :return: list of group entities
+    """
+    if isinstance(catalog, SnapshotCatalog):
+        return catalog.group_entities
+    return list(catalog.getPathBuilder().public.ERMrest_Group.entities())
+
+
+def save_catalog_snapshot(catalog, filename):
+    """
+    Save the /schema document and the ERMrest_Group table of a catalog to a gzip compressed JSON file, which can be
+    loaded with SnapshotCatalog.
+    :param catalog: ErmrestCatalog
+    :param filename: name of the snapshot file
+    :return: snaptime of the catalog when the snapshot was taken, if the server provides one
+    """
+    snaptime = (catalog.get('/').json() or {}).get('snaptime')
+    snapshot = {
+        'server_uri': catalog.get_server_uri(),
+        'snaptime': snaptime,
+        'schema': catalog.get('/schema').json(),
+        'groups': catalog_group_entities(catalog)
+    }
+    # Write under a different name and rename, so an existing snapshot is never left half written.
+    with gzip.open(filename + '.tmp', 'wt', encoding='utf-8') as f:
+        json.dump(snapshot, f)
+    os.replace(filename + '.tmp', filename)
+    return snaptime
+
+
 class TempErmrestCatalog(ErmrestCatalog):
     """
     Create a new catalog.  Can be used as as context so that catalog is automatically deleted.
@@ -80,3 +157,187 @@ def create_new_catalog(scheme, server, **kwargs):
     catalog_id = catalog.get_server_uri().split('/')[-1]
     return catalog_id
 
+
+def external_sort(rows, key, buffer_size=100000, merge_width=64, tmpdir=None):
+    """
+    Sort an iterable that may be too large to fit in memory.  Rows are sorted buffer_size rows at a time and each
+    sorted run is spilled to a temporary file.  The runs are then merged lazily, so only one batch of rows from each run
+    is in memory at a time. The sort is stable, so the order is the same as sorted(rows, key=key).
+    :param rows: Iterable of rows to be sorted
+    :param key: Function used to get the sort key of a row
+    :param buffer_size: Number of rows to sort in memory
+    :param merge_width: Largest number of runs to merge at once.  With more runs than this, groups of runs are merged
+                        into longer runs first, so each row is merged about log(runs, merge_width) times.
+    :param tmpdir: Directory for the spill files
+    :return: generator of rows in sorted order.
+    """
+    batch_size = 1000
+
+    def spill(sorted_rows):
+        run = tempfile.TemporaryFile(dir=tmpdir)
+        sorted_rows = iter(sorted_rows)
+        while True:
+            batch = list(itertools.islice(sorted_rows, batch_size))
+            if not batch:
+                break
+            pickle.dump(batch, run, pickle.HIGHEST_PROTOCOL)
+        run.seek(0)
+        return run
+
+    def read_run(run):
+        try:
+            while True:
+                for row in pickle.load(run):
+                    yield row
+        except EOFError:
+            pass
+        finally:
+            run.close()
+
+    def merge(runs):
+        # heapq.merge breaks ties by the order of its inputs, which keeps the merge stable as long as the runs are
+        # given in the order their rows were read.
+        return heapq.merge(*[read_run(r) for r in runs], key=key)
+
+    # levels[i] holds the runs that have been merged i times, in the order they were read.  When a level is full, its
+    # runs are merged into one run on the next level, which keeps the number of open runs down while reading.
+    levels = [[]]
+    rows = iter(rows)
+    while True:
+        buffer = list(itertools.islice(rows, buffer_size))
+        if len(buffer) < buffer_size and levels == [[]]:
+            # Everything fit in memory, so don't bother with the disk.
+            buffer.sort(key=key)
+            for row in buffer:
+                yield row
+            return
+        if not buffer:
+            break
+        buffer.sort(key=key)
+        levels[0].append(spill(buffer))
+        del buffer
+        level = 0
+        while len(levels[level]) == merge_width:
+            if level + 1 == len(levels):
+                levels.append([])
+            levels[level + 1].append(spill(merge(levels[level])))
+            levels[level] = []
+            level += 1
+
+    # Runs on higher levels hold the rows that were read first.  Merge groups of runs until one merge can finish.
+    runs = [run for level in reversed(levels) for run in level]
+    while len(runs) > merge_width:
+        runs = [spill(merge(runs[i:i + merge_width])) for i in range(0, len(runs), merge_width)]
+    for row in merge(runs):
+        yield row
+
+
+def key_digest(values, digest_size=16):
+    """
+    Compute a digest of the values of a key that is compact enough to keep millions of keys in a set.  With the
+    default of 128 bits, different keys will not have the same digest in practice.
+    :param values: sequence of key values
+    :param digest_size: number of bytes in the digest
+    :return: digest as bytes
+    """
+    data = '\x1f'.join('' if v is None else str(v) for v in values).encode('utf-8')
+    return hashlib.blake2b(data, digest_size=digest_size).digest()
+
+
+def key_hash(values):
+    """
+    Compute a 64 bit hash of the values of a key.  Unlike hash(), the result is the same in every process.
+    :param values: sequence of key values
+    :return: non-zero integer less than 2**64
+    """
+    return int.from_bytes(key_digest(values, digest_size=8), 'big') or 1
+
+
+class KeyIndex:
+    """
+    Index of 64 bit key hashes and the row numbers they came from, used to find duplicate keys in tables that are too
+    large to keep their keys in memory.  Hashes are spread over bucket files on disk by their low bits, so finding the
+    repeated hashes only needs one bucket in memory at a time.  Matching hashes are only candidates: the keys of the
+    rows have to be compared to rule out hash collisions.
+    """
+
+    def __init__(self, buckets=256, buffer_size=4096, tmpdir=None):
+        """
+        :param buckets: Number of bucket files.  Each bucket holds about 1/buckets of the rows.
+        :param buffer_size: Number of entries buffered in memory for each bucket before it is written to disk
+        :param tmpdir: Directory for the bucket files
+        """
+        self.buffer_size = buffer_size
+        self._files = [tempfile.TemporaryFile(dir=tmpdir) for _ in range(buckets)]
+        self._buffers = [array('Q') for _ in range(buckets)]
+
+    def add(self, hash_value, row_number):
+        """
+        Add a key to the index.
+        :param hash_value: 64 bit hash of the key, as returned by key_hash
+        :param row_number: row the key came from
+        """
+        bucket = hash_value % len(self._buffers)
+        buffer = self._buffers[bucket]
+        buffer.append(hash_value)
+        buffer.append(row_number)
+        if len(buffer) >= 2 * self.buffer_size:
+            buffer.tofile(self._files[bucket])
+            del buffer[:]
+
+    def candidates(self):
+        """
+        Find the rows whose key hash is shared with another row.
+        :return: dictionary mapping row number to hash for every row whose hash is not unique
+        """
+        candidates = {}
+        for bucket_file, buffer in zip(self._files, self._buffers):
+            buffer.tofile(bucket_file)
+            del buffer[:]
+            bucket_file.seek(0)
+            entries = array('Q')
+            entries.frombytes(bucket_file.read())
+            first_rows = {}
+            for hash_value, row_number in zip(entries[::2], entries[1::2]):
+                first_row = first_rows.setdefault(hash_value, row_number)
+                if first_row != row_number:
+                    candidates[first_row] = hash_value
+                    candidates[row_number] = hash_value
+        return candidates
+
+    def close(self):
+        for bucket_file in self._files:
+            bucket_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def duplicate_keys(read_rows, key, buckets=256, tmpdir=None):
+    """
+    Find the rows of a table that have the same key.  The table is read twice: once to build a KeyIndex of key hashes,
+    and once more to compare the keys of the rows whose hashes match, so only the rows with duplicate hashes are held
+    in memory.
+    :param read_rows: Function that returns an iterable of (row_number, row) for the table.  Called twice.
+    :param key: Function that returns the tuple of key values for a row, or None if the row has no key.
+    :param buckets: Number of buckets in the index
+    :param tmpdir: Directory for the index files
+    :return: list of (key, row numbers) for each duplicated key, in the order the keys first appear
+    """
+    with KeyIndex(buckets=buckets, tmpdir=tmpdir) as index:
+        for row_number, row in read_rows():
+            values = key(row)
+            if values is not None:
+                index.add(key_hash(values), row_number)
+        candidates = index.candidates()
+
+    if not candidates:
+        return []
+    rows_by_key = {}
+    for row_number, row in read_rows():
+        if row_number in candidates:
+            rows_by_key.setdefault(tuple(key(row)), []).append(row_number)
+    return sorted([(k, v) for k, v in rows_by_key.items() if len(v) > 1], key=lambda x: x[1][0])
@@ -64,6 +64,10 @@ setup(
         'attrdict',
         'deriva>=0.6.7'
     ],
+    extras_require={
+        'arrow': ['pyarrow'],
+        'zstd': ['zstandard']
+    },
     license='Apache 2.0',
     classifiers=[
         'Intended Audience :: Science/Research',
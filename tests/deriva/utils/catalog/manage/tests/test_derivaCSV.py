@@ -1,6 +1,8 @@
 from unittest import TestCase
 import datetime
 import os
+import bz2
+import json
 import csv
 import sys
 import string
@@ -8,12 +10,17 @@ import tempfile
 import random
 import warnings
 
+import requests
+import tabulator
 from tableschema import exceptions
-from deriva.utils.catalog.manage.deriva_csv import DerivaCSV, load_module_from_path
+from deriva.utils.catalog.manage.deriva_csv import DerivaCSV, AdaptiveChunkSize, load_module_from_path, \
+    batch_manifest, create_validate_upload_tables, DerivaCSVError, DerivaUploadError, UploadJournal, \
+    infer_column_types
 import deriva.utils.catalog.manage.dump_catalog as dump_catalog
 from deriva.core import get_credential
 import deriva.core.ermrest_model as em
-from deriva.utils.catalog.manage.utils import TempErmrestCatalog
+from deriva.utils.catalog.manage.utils import TempErmrestCatalog, external_sort
+from deriva.utils.catalog.manage.csv_source import read_rows
 
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 
@@ -132,6 +139,88 @@ class TestDerivaCSV(TestCase):
         self.assertEqual(table.map_name('amountDna'), 'Amount_DNA')
         self.assertEqual(table.map_name('the hun'), 'Attila_The_Hun')
         self.assertEqual(table.map_name('the clown'), 'Bozo_The_Clown')
+        self.assertEqual(table.map_names(['amountDna', 'the hun', 'amountDna']),
+                         ['Amount_DNA', 'Attila_The_Hun', 'Amount_DNA'])
+        self.assertEqual(table.map_name('amountDna', {}), 'Amount_Dna')
+
+    def test_infer_columnar(self):
+        table = DerivaCSV(self.tablefile, self.schema_name, key_columns='id', column_map=True)
+        table.infer(columnar=False)
+        descriptor = table.schema.descriptor
+
+        table = DerivaCSV(self.tablefile, self.schema_name, key_columns='id', column_map=True)
+        table.infer()
+        self.assertEqual(table.schema.descriptor, descriptor)
+        self.assertEqual(table.row_count, self.table_size)
+
+    def test_infer_sample(self):
+        table = DerivaCSV(self.tablefile, self.schema_name, key_columns='id', column_map=True)
+        table.infer()
+        descriptor = table.schema.descriptor
+
+        for sample in ['reservoir', 'blocks']:
+            table = DerivaCSV(self.tablefile, self.schema_name, key_columns='id', column_map=True)
+            table.infer(sample=sample, sample_size=100)
+            self.assertEqual(table.schema.descriptor, descriptor)
+            self.assertEqual(set(table.type_confidence), set(table.headers))
+            self.assertTrue(all(0 < c <= 1 for c in table.type_confidence.values()))
+
+    def test_infer_limit(self):
+        table = DerivaCSV(self.tablefile, self.schema_name, key_columns='id', column_map=True)
+        table.infer(limit=2 * self.table_size)
+        self.assertEqual(table.row_count, self.table_size)
+        self.assertTrue(all(c == 1 for c in table.type_confidence.values()))
+
+        # Types found in part of the table are not certain, unless the column is a string.
+        for columnar in [True, False]:
+            table = DerivaCSV(self.tablefile, self.schema_name, key_columns='id', column_map=True)
+            table.infer(limit=100, columnar=columnar)
+            self.assertEqual(table.row_count, 100)
+            self.assertTrue(all((c == 1) == (field.type == 'string')
+                                for field, c in zip(table.schema.fields, table.type_confidence.values())))
+
+        # Rows are still counted once every column is a string.
+        self.assertEqual(infer_column_types([['a', '1']] + [['b', 'c']] * 99, block_size=10), ([str, str], 100))
+
+    def test_read_rows_crlf(self):
+        # Line breaks in quoted values are read the same way tabulator reads them, whatever the line endings are.
+        crlf_file = '{}/crlf.csv'.format(self.test_dir)
+        with open(crlf_file, 'wb') as f:
+            f.write(b'id,text\r\n1,"a\r\nb"\r\n2,"c\rd"\r\n3,"e\nf"\r\n4,plain\r\n')
+        with tabulator.Stream(crlf_file, headers=1) as stream:
+            expected = list(stream.iter())
+        self.assertEqual(list(read_rows(crlf_file)), expected)
+
+        # The mapping of the file is released on close, and made again if the file is read after that.
+        with DerivaCSV(crlf_file, self.schema_name, key_columns='id') as table:
+            table.infer(sample='blocks')
+            self.assertEqual(table.row_count, len(expected))
+        table.infer(processes=2)
+        self.assertEqual(table.row_count, len(expected))
+        table.close()
+
+    def test_infer_processes(self):
+        table = DerivaCSV(self.tablefile, self.schema_name, key_columns='id', column_map=True)
+        table.infer()
+        descriptor = table.schema.descriptor
+
+        table = DerivaCSV(self.tablefile, self.schema_name, key_columns='id', column_map=True)
+        table.infer(processes=4)
+        self.assertEqual(table.schema.descriptor, descriptor)
+        self.assertEqual(table.row_count, self.table_size)
+
+    def test_infer_cache(self):
+        table = DerivaCSV(self.tablefile, self.schema_name, key_columns='id', column_map=True)
+        table.infer(columnar=False, cache_size=None)
+        descriptor = table.schema.descriptor
+        self.assertEqual(table.inference_cache_stats, {})
+
+        table = DerivaCSV(self.tablefile, self.schema_name, key_columns='id', column_map=True)
+        table.infer(columnar=False)
+        self.assertEqual(table.schema.descriptor, descriptor)
+        stats = table.inference_cache_stats['field 2']
+        self.assertEqual(stats['misses'], 2)  # Only true and false are classified.
+        self.assertGreater(stats['hit_rate'], .9)
 
     def test_convert_to_deriva(self):
         self.table = DerivaCSV(self.tablefile, self.schema_name, key_columns='id', column_map=True)
@@ -182,6 +271,46 @@ class TestDerivaCSV(TestCase):
         self.assertEqual([i['type'] for i in self.table.schema.descriptor['fields']],
                          [i['type'] for i in tableschema.descriptor['fields']])
 
+    def test_table_schema_from_catalog_cache(self):
+        self.table = DerivaCSV(self.tablefile, self.schema_name, key_columns='id', column_map=True)
+        self._create_test_table()
+        tableschema = self.table.table_schema_from_catalog(self.catalog)
+
+        # The model isn't fetched again until the catalog changes.
+        catalog_get = self.catalog.get
+        fetches = []
+        self.catalog.get = lambda path, *args, **kwargs: fetches.append(path) or catalog_get(path, *args, **kwargs)
+        self.assertEqual(self.table.table_schema_from_catalog(self.catalog).descriptor, tableschema.descriptor)
+        self.assertEqual(fetches.count('/schema'), 0)
+        self.table.upload_to_deriva(self.catalog)
+        self.table.table_schema_from_catalog(self.catalog)
+        self.assertEqual(fetches.count('/schema'), 1)
+
+    def test_upload_to_deriva_schema_fetches(self):
+        self.table = DerivaCSV(self.tablefile, self.schema_name, key_columns='id', column_map=True)
+        self._create_test_table()
+        self.table.table_schema_from_catalog(self.catalog)
+
+        catalog_get = self.catalog.get
+        fetches = []
+        self.catalog.get = lambda path, *args, **kwargs: fetches.append(path) or catalog_get(path, *args, **kwargs)
+
+        # The path builder is made from the model fetched for the table schema, which is fetched again once the
+        # upload has changed the catalog.
+        self.table.upload_to_deriva(self.catalog)
+        self.assertEqual(fetches.count('/schema'), 0)
+        self.table.upload_to_deriva(self.catalog, skip_existing=True)
+        self.assertEqual(fetches.count('/schema'), 1)
+        self.table.upload_to_deriva(self.catalog, skip_existing=True)
+        self.assertEqual(fetches.count('/schema'), 1)
+
+        # The catalog isn't asked for its snaptime when it wouldn't be used.
+        model, pathbuilder = self.catalog.getCatalogModel(), self.catalog.getPathBuilder()
+        del fetches[:]
+        self.table.upload_to_deriva(self.catalog, skip_existing=True, model=model, pathbuilder=pathbuilder)
+        self.assertNotIn('/', fetches)
+        self.assertNotIn('/schema', fetches)
+
     def test_table_schema_from_catalog_compound(self):
         self.table = DerivaCSV(self.tablefile, self.schema_name, key_columns=[['id','field 1']], column_map=True)
         self._create_test_table()
@@ -200,6 +329,65 @@ class TestDerivaCSV(TestCase):
         self._create_test_table()
         self.table.validate(self.catalog)
 
+    def test_check_keys(self):
+        table = DerivaCSV(self.tablefile, self.schema_name, key_columns='id', column_map=True)
+        self.assertEqual(table.check_keys(), [])
+
+        with open(self.tablefile, newline='') as f:
+            rows = list(csv.reader(f))
+        rows[-1][0] = rows[1][0]
+        with open(self.tablefile, 'w', newline='') as f:
+            csv.writer(f).writerows(rows)
+        self.assertEqual(table.check_keys(), [(['id'], (rows[1][0],), [2, self.table_size + 1])])
+
+    def test_validate_processes(self):
+        self.table = DerivaCSV(self.tablefile, self.schema_name, key_columns='id', column_map=True)
+        self._create_test_table()
+
+        # Duplicate a key near the end of the table, so it has to be found across shards.
+        with open(self.tablefile, newline='') as f:
+            rows = list(csv.reader(f))
+        rows[-1][0] = rows[1][0]
+        with open(self.tablefile, 'w', newline='') as f:
+            csv.writer(f).writerows(rows)
+
+        valid, report = self.table.validate(self.catalog, processes=4)
+        self.assertFalse(valid)
+        self.assertEqual([(i['code'], i['row-number']) for i in report['tables'][0]['errors']],
+                         [('unique-constraint', self.table_size + 1)])
+
+    def test_validate_rows(self):
+        self.table = DerivaCSV(self.tablefile, self.schema_name, key_columns='id', column_map=True)
+        self._create_test_table()
+
+        # A blank row, a copy of another row, a key that is only different in how it is written, and a copy of a row
+        # with a bad value, which is only reported as a duplicate.
+        with open(self.tablefile, newline='') as f:
+            rows = list(csv.reader(f))
+        rows[20] = [''] * len(rows[0])
+        rows[30] = list(rows[25])
+        rows[40][0] = '0' + rows[41][0]
+        rows[50][1] = 'x'
+        rows[51] = list(rows[50])
+        with open(self.tablefile, 'w', newline='') as f:
+            csv.writer(f).writerows(rows)
+        expected = [('blank-row', 21), ('duplicate-row', 31), ('unique-constraint', 42), ('type-or-format-error', 51),
+                    ('duplicate-row', 52)]
+
+        reports = []
+        for processes in [1, 4]:
+            valid, report = self.table.validate(self.catalog, processes=processes)
+            self.assertFalse(valid)
+            self.assertEqual([(i['code'], i['row-number']) for i in report['tables'][0]['errors']], expected)
+            reports.append((report['error-count'], [(i['code'], i['row-number'], i['column-number'])
+                                                    for i in report['tables'][0]['errors']]))
+        self.assertEqual(reports[0], reports[1])
+
+        row_count, _ = self.table.upload_to_deriva(self.catalog, validate=True)
+        self.assertEqual(row_count, self.table_size - len(expected))
+        self.assertEqual([(i['code'], i['row-number'])
+                          for i in self.table.validation_report['tables'][0]['errors']], expected)
+
     def test_upload_to_deriva(self):
         self.table = DerivaCSV(self.tablefile, self.schema_name, key_columns='id', column_map=True)
         self._create_test_table()
@@ -243,6 +431,317 @@ class TestDerivaCSV(TestCase):
         target_table = pb.schemas[self.schema_name].tables[self.table.map_name(self.table_name)].alias('target_table')
         self.assertEqual(len(list(target_table.entities())), self.table_size)
 
+    def test_upload_to_deriva_streaming(self):
+        self.table = DerivaCSV(self.tablefile, self.schema_name, key_columns='id', column_map=True)
+        self._create_test_table()
+
+        # get part of table:
+        pfile_name = '{}/{}_partial.csv'.format(self.test_dir, self.table_name)
+
+        with open(self.tablefile, 'r') as wholefile:
+            with open(pfile_name, 'w', newline='') as partfile:
+                tablereader = csv.reader(wholefile)
+                tablewriter = csv.writer(partfile)
+                for i in range(self.table_size // 2):
+                    tablewriter.writerow(next(tablereader))
+
+        partial_table = DerivaCSV(pfile_name, self.schema_name, table_name=self.table_name, key_columns='id',
+                                  column_map=True)
+        partial_row_count, _ = partial_table.upload_to_deriva(self.catalog, chunk_size=100, streaming=True)
+        self.assertEqual(partial_row_count, self.table_size // 2 - 1)
+
+        row_count, _ = self.table.upload_to_deriva(self.catalog, chunk_size=100, streaming=True)
+        self.assertEqual(row_count, self.table_size - (self.table_size // 2 - 1))
+
+        pb = self.catalog.getPathBuilder()
+        target_table = pb.schemas[self.schema_name].tables[self.table.map_name(self.table_name)].alias('target_table')
+        self.assertEqual(len(list(target_table.entities())), self.table_size)
+
+    def test_external_sort(self):
+        # Few distinct keys, so the order of rows with the same key shows whether the sort is stable.
+        rows = [(random.randrange(10), i) for i in range(1000)]
+        for buffer_size, merge_width in [(1000, 64), (10, 64), (10, 3), (7, 2)]:
+            self.assertEqual(list(external_sort(rows, lambda r: r[0], buffer_size=buffer_size,
+                                                merge_width=merge_width)),
+                             sorted(rows, key=lambda r: r[0]))
+
+    def test_upload_to_deriva_workers(self):
+        self.table = DerivaCSV(self.tablefile, self.schema_name, key_columns='id', column_map=True)
+        self._create_test_table()
+        journal = '{}/{}.journal'.format(self.test_dir, self.table_name)
+        row_count, _ = self.table.upload_to_deriva(self.catalog, chunk_size=100, workers=4, journal=journal)
+        self.assertEqual(row_count, self.table_size)
+        self.assertFalse(os.path.exists(journal))
+
+        pb = self.catalog.getPathBuilder()
+        target_table = pb.schemas[self.schema_name].tables[self.table.map_name(self.table_name)].alias('target_table')
+        self.assertEqual(sorted([i['Id'] for i in target_table.entities()]), list(range(1, self.table_size + 1)))
+
+    def test_upload_to_deriva_workers_partial(self):
+        self.table = DerivaCSV(self.tablefile, self.schema_name, key_columns='id', column_map=True)
+        self._create_test_table()
+
+        # Upload half the table without a journal, and then finish it off with workers.
+        pfile_name = '{}/{}_partial.csv'.format(self.test_dir, self.table_name)
+        with open(self.tablefile, 'r') as wholefile:
+            with open(pfile_name, 'w', newline='') as partfile:
+                tablereader = csv.reader(wholefile)
+                tablewriter = csv.writer(partfile)
+                for i in range(self.table_size // 2):
+                    tablewriter.writerow(next(tablereader))
+        partial_table = DerivaCSV(pfile_name, self.schema_name, table_name=self.table_name, key_columns='id',
+                                  column_map=True)
+        partial_row_count, _ = partial_table.upload_to_deriva(self.catalog)
+        self.assertEqual(partial_row_count, self.table_size // 2 - 1)
+
+        # The journal is kept in the temporary directory rather than next to the source.
+        journal = UploadJournal.default_filename(self.catalog.get_server_uri(),
+                                                 '{}:{}'.format(self.schema_name, self.table_name))
+        self.assertEqual(os.path.dirname(journal), tempfile.gettempdir())
+        row_count, _ = self.table.upload_to_deriva(self.catalog, chunk_size=100, workers=4)
+        self.assertEqual(row_count, self.table_size - (self.table_size // 2 - 1))
+        self.assertFalse(os.path.exists(journal))
+        self.assertEqual([f for f in os.listdir(self.test_dir) if f.endswith('.journal')], [])
+
+        pb = self.catalog.getPathBuilder()
+        target_table = pb.schemas[self.schema_name].tables[self.table.map_name(self.table_name)].alias('target_table')
+        self.assertEqual(sorted([i['Id'] for i in target_table.entities()]), list(range(1, self.table_size + 1)))
+
+    def test_upload_to_deriva_journal_mode(self):
+        self.table = DerivaCSV(self.tablefile, self.schema_name, key_columns='id', column_map=True)
+        self._create_test_table()
+
+        # A journal left by an upload that read the rows a different way can't be resumed.
+        journal = '{}/{}.journal'.format(self.test_dir, self.table_name)
+        table_name = '{}:{}'.format(self.schema_name, self.table_name)
+        j = UploadJournal(journal, table_name, mode={'streaming': False, 'key_order': True, 'validate': False})
+        j.record(0, 100)
+        j.close()
+        with self.assertRaises(DerivaCSVError):
+            self.table.upload_to_deriva(self.catalog, chunk_size=100, streaming=True, journal=journal)
+
+        row_count, _ = self.table.upload_to_deriva(self.catalog, chunk_size=100, journal=journal)
+        self.assertEqual(row_count, self.table_size - 100)
+
+    def test_upload_to_deriva_validate_inline(self):
+        self.table = DerivaCSV(self.tablefile, self.schema_name, key_columns='id', column_map=True)
+        self._create_test_table()
+
+        # Put a bad value into the table, and a copy of the row with it, which goodtables only reports as a duplicate.
+        with open(self.tablefile, newline='') as f:
+            rows = list(csv.reader(f))
+        rows[10][0] = 'not an id'
+        rows[11] = list(rows[10])
+        with open(self.tablefile, 'w', newline='') as f:
+            csv.writer(f).writerows(rows)
+        expected = [('type-or-format-error', 11), ('duplicate-row', 12)]
+
+        row_count, _ = self.table.upload_to_deriva(self.catalog, validate=True)
+        self.assertEqual(row_count, self.table_size - len(expected))
+        report = self.table.validation_report
+        self.assertFalse(report['valid'])
+        self.assertEqual(report['error-count'], len(expected))
+        self.assertEqual([(i['code'], i['row-number']) for i in report['tables'][0]['errors']], expected)
+
+    def test_upload_to_deriva_skip_existing(self):
+        self.table = DerivaCSV(self.tablefile, self.schema_name, key_columns='id', column_map=True)
+        self._create_test_table()
+
+        # Put part of the table in out of order, and then fill in the rest.
+        pb = self.catalog.getPathBuilder()
+        target_table = pb.schemas[self.schema_name].tables[self.table.map_name(self.table_name)].alias('target_table')
+        target_table.insert([{'Id': i} for i in range(self.table_size, 0, -3)])
+        row_count, _ = self.table.upload_to_deriva(self.catalog, chunk_size=100, skip_existing=True, page_size=50)
+        self.assertEqual(row_count, self.table_size - len(range(self.table_size, 0, -3)))
+        self.assertEqual(sorted([i['Id'] for i in target_table.entities()]), list(range(1, self.table_size + 1)))
+
+        row_count, _ = self.table.upload_to_deriva(self.catalog, skip_existing=True)
+        self.assertEqual(row_count, 0)
+
+    def test_upload_to_deriva_skip_existing_timestamp(self):
+        # Timestamps without a time zone in the table, which ERMrest returns with one.
+        tablefile = '{}/Times.csv'.format(self.test_dir)
+        rows = [['Time', 'Value']] + \
+               [['2020-01-02 {:02d}:{:02d}:00'.format(i // 60, i % 60), str(i)] for i in range(300)]
+        with open(tablefile, 'w', newline='') as f:
+            csv.writer(f).writerows(rows)
+
+        model = self.catalog.getCatalogModel()
+        model.schemas[self.schema_name].create_table(self.catalog, em.Table.define(
+            'Times', [em.Column.define('Time', em.builtin_types.timestamptz, nullok=False),
+                      em.Column.define('Value', em.builtin_types.text)],
+            key_defs=[em.Key.define(['Time'])]))
+        pb = self.catalog.getPathBuilder()
+        target_table = pb.schemas[self.schema_name].tables['Times'].alias('target_table')
+        target_table.insert([{'Time': r[0], 'Value': r[1]} for r in rows[1::3]])
+
+        table = DerivaCSV(tablefile, self.schema_name, table_name='Times', key_columns='Time', column_map=True)
+        row_count, _ = table.upload_to_deriva(self.catalog, chunk_size=100, skip_existing=True)
+        self.assertEqual(row_count, len(rows) - 1 - len(rows[1::3]))
+        self.assertEqual(len(list(target_table.entities())), len(rows) - 1)
+
+    def test_upload_to_deriva_skip_existing_id(self):
+        pfile_name = '{}/{}_partial.csv'.format(self.test_dir, self.table_name)
+        with open(self.tablefile, 'r') as wholefile:
+            with open(pfile_name, 'w', newline='') as partfile:
+                tablereader = csv.reader(wholefile)
+                tablewriter = csv.writer(partfile)
+                for i in range(self.table_size // 2):
+                    tablewriter.writerow(next(tablereader))
+
+        self.table = DerivaCSV(self.tablefile, self.schema_name, table_name=self.table_name,
+                               row_number_as_key=True, column_map=True)
+        partial_table = DerivaCSV(pfile_name, self.schema_name, table_name=self.table_name,
+                                  row_number_as_key=True, column_map=True)
+        self._create_test_table()
+        partial_row_count, partial_upload_id = partial_table.upload_to_deriva(self.catalog)
+
+        # Skipping existing rows carries on with the last upload rather than starting a new one.
+        row_count, upload_id = self.table.upload_to_deriva(self.catalog, skip_existing=True)
+        self.assertEqual(upload_id, partial_upload_id)
+        self.assertEqual(row_count, self.table_size - partial_row_count)
+
+        pb = self.catalog.getPathBuilder()
+        target_table = pb.schemas[self.schema_name].tables[self.table.map_name(self.table_name)].alias('target_table')
+        self.assertEqual(len(list(target_table.entities())), self.table_size)
+
+    def test_upload_to_deriva_arrow(self):
+        try:
+            import pyarrow.csv
+            import pyarrow.parquet
+            from deriva.utils.catalog.manage.deriva_arrow import DerivaArrow
+        except ImportError:
+            self.skipTest('pyarrow is not installed')
+        parquet_file = '{}/{}.parquet'.format(self.test_dir, self.table_name)
+        pyarrow.parquet.write_table(pyarrow.csv.read_csv(self.tablefile), parquet_file)
+
+        self.table = DerivaArrow(parquet_file, self.schema_name, key_columns='id', column_map=True, batch_size=300)
+        self.assertEqual(self.table.schema.get_field('id').type, 'integer')
+        self._create_test_table()
+        row_count, _ = self.table.upload_to_deriva(self.catalog, chunk_size=100, validate=True)
+        self.assertEqual(row_count, self.table_size)
+        self.assertTrue(self.table.validation_report['valid'])
+
+    def test_upload_to_deriva_compressed(self):
+        compressed_file = self.tablefile + '.bz2'
+        with open(self.tablefile, 'rb') as f, bz2.open(compressed_file, 'wb') as c:
+            c.write(f.read())
+
+        self.table = DerivaCSV(compressed_file, self.schema_name, table_name=self.table_name, key_columns='id',
+                               column_map=True)
+        self.table.infer()
+        self.assertEqual(self.table.row_count, self.table_size)
+        table = DerivaCSV(self.tablefile, self.schema_name, key_columns='id', column_map=True)
+        table.infer()
+        self.assertEqual(self.table.schema.descriptor, table.schema.descriptor)
+        self._create_test_table()
+        row_count, _ = self.table.upload_to_deriva(self.catalog, chunk_size=100, validate=True)
+        self.assertEqual(row_count, self.table_size)
+        self.assertTrue(self.table.validation_report['valid'])
+
+    def test_create_validate_upload_tables(self):
+        # Load the test table and a copy of it in one batch.
+        copyfile = '{}/{}Copy.csv'.format(self.test_dir, self.table_name)
+        with open(self.tablefile) as f, open(copyfile, 'w') as c:
+            c.write(f.read())
+        entries = batch_manifest(self.test_dir, self.schema_name, key_columns='id')
+        self.assertEqual([os.path.basename(e['tabledata']) for e in entries],
+                         [os.path.basename(self.tablefile), os.path.basename(copyfile)])
+
+        results = create_validate_upload_tables(self.catalog, entries, jobs=2, create=True, validate=True,
+                                                upload=True, chunk_size=100, adaptive={'target_latency': 1.0})
+        self.assertEqual([(r['table'], r['status'], r['valid'], r['rows']) for r in results],
+                         [('Test_Table', 'ok', True, self.table_size),
+                          ('Test_Table_Copy', 'ok', True, self.table_size)])
+
+    def test_upload_to_deriva_metrics(self):
+        self.table = DerivaCSV(self.tablefile, self.schema_name, key_columns='id', column_map=True)
+        self._create_test_table()
+        metrics_file = '{}/{}.jsonl'.format(self.test_dir, self.table_name)
+        row_count, _ = self.table.upload_to_deriva(self.catalog, chunk_size=300, metrics=metrics_file)
+        self.assertEqual(row_count, self.table_size)
+
+        with open(metrics_file) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual([(r['type'], r['rows']) for r in records],
+                         [('chunk', 300), ('chunk', 300), ('chunk', 300), ('chunk', 100), ('upload', self.table_size)])
+        self.assertEqual(records[-1], self.table.upload_metrics)
+        self.assertFalse(self.table.upload_metrics['failed'])
+
+    def test_upload_to_deriva_adaptive(self):
+        self.table = DerivaCSV(self.tablefile, self.schema_name, key_columns='id', column_map=True)
+        self._create_test_table()
+        chunk_size = AdaptiveChunkSize(50, target_latency=1.0, min_size=10, max_size=400)
+        row_count, _ = self.table.upload_to_deriva(self.catalog, chunk_size=chunk_size)
+        self.assertEqual(row_count, self.table_size)
+        self.assertTrue(chunk_size.min_size <= chunk_size.size <= chunk_size.max_size)
+
+    def _bad_value_table(self, row):
+        """
+        Put a value that the catalog will reject into the date column of a row of the test table.
+        """
+        with open(self.tablefile, newline='') as f:
+            rows = list(csv.reader(f))
+        rows[row][rows[0].index('field 4')] = 'not a date'
+        with open(self.tablefile, 'w', newline='') as f:
+            csv.writer(f).writerows(rows)
+
+    def _check_journal(self, journal):
+        """
+        Check that the rows recorded in an upload journal are the ones that are in the catalog.
+        """
+        j = UploadJournal(journal, '{}:{}'.format(self.schema_name, self.table_name))
+        pb = self.catalog.getPathBuilder()
+        target_table = pb.schemas[self.schema_name].tables[self.table.map_name(self.table_name)].alias('target_table')
+        self.assertEqual(sorted([i['Id'] for i in target_table.entities()]),
+                         [i + 1 for i in range(self.table_size) if i in j])
+        return j
+
+    def test_upload_to_deriva_client_error(self):
+        self.table = DerivaCSV(self.tablefile, self.schema_name, key_columns='id', column_map=True)
+        self._create_test_table()
+        self._bad_value_table(550)
+
+        journal = '{}/{}.journal'.format(self.test_dir, self.table_name)
+        with self.assertRaises(DerivaUploadError) as context:
+            self.table.upload_to_deriva(self.catalog, chunk_size=100, journal=journal)
+        self.assertEqual(context.exception.response.status_code, 400)
+
+        j = self._check_journal(journal)
+        self.assertTrue(all(i in j for i in range(500)))
+        self.assertNotIn(549, j)
+
+    def test_upload_to_deriva_server_error(self):
+        self.table = DerivaCSV(self.tablefile, self.schema_name, key_columns='id', column_map=True)
+        self._create_test_table()
+        self._bad_value_table(580)
+
+        # Fail the first insert of the sixth chunk with a server error, so that it is split in half.
+        post = self.catalog.post
+        failed = []
+
+        def flaky_post(path, **kwargs):
+            if not failed and kwargs.get('json') and kwargs['json'][0]['Id'] == 501:
+                failed.append(path)
+                response = requests.Response()
+                response.status_code = 503
+                response._content = b'Service Unavailable'
+                raise requests.HTTPError('503 Service Unavailable', response=response)
+            return post(path, **kwargs)
+
+        self.catalog.post = flaky_post
+        journal = '{}/{}.journal'.format(self.test_dir, self.table_name)
+        chunk_size = AdaptiveChunkSize(100, min_size=100, max_size=100, retry_delay=0)
+        with self.assertRaises(DerivaUploadError) as context:
+            self.table.upload_to_deriva(self.catalog, chunk_size=chunk_size, journal=journal)
+        self.assertEqual(context.exception.response.status_code, 400)
+        self.assertEqual(len(failed), 1)
+
+        # The first half of the chunk that was split made it in, and the half with the bad value did not.
+        j = self._check_journal(journal)
+        self.assertTrue(all(i in j for i in range(550)))
+        self.assertNotIn(579, j)
+
     def test_upload_to_deriva_upload_id(self):
         self.table = DerivaCSV(self.tablefile, self.schema_name, column_map=True, row_number_as_key=True)
         self._create_test_table()
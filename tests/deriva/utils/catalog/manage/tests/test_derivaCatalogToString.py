@@ -1,11 +1,16 @@
 from unittest import TestCase
+import gzip
+import json
+import os
 import tempfile
 import sys
 import deriva.core.ermrest_model as em
-from deriva.utils.catalog.manage.utils import TempErmrestCatalog
+from deriva.utils.catalog.manage.utils import TempErmrestCatalog, LoopbackCatalog, SnapshotCatalog, \
+    save_catalog_snapshot
 from deriva.core import get_credential
 from deriva.core.ermrest_config import tag as chaise_tags
-from deriva.utils.catalog.manage.dump_catalog import DerivaCatalogToString
+from deriva.utils.catalog.manage.dump_catalog import DerivaCatalogToString, dump_manifest, changed_files, \
+    yapf_format
 from deriva.utils.catalog.manage.deriva_csv import load_module_from_path
 
 if sys.version_info >= (3, 0):
@@ -20,7 +25,125 @@ class TestDerivaCatalogToString(TestCase):
         self.credentials = get_credential(self.server)
 
     def test_substitute_variables(self):
-        pass
+        groups = {'admin': 'https://auth.globus.org/0001', 'reader': 'https://auth.globus.org/0002'}
+        stringer = DerivaCatalogToString(LoopbackCatalog(), groups=groups)
+        code = stringer.substitute_variables(
+            "{{'select': ['https://auth.globus.org/0001', 'https://auth.globus.org/00012'], {!r}: {{}}}}".format(
+                chaise_tags.display))
+        self.assertEqual(code, "{'select': [groups['admin'], 'https://auth.globus.org/00012'], "
+                               "chaise_tags.display: {}}")
+        self.assertEqual(stringer._referenced_groups, {'admin': 'https://auth.globus.org/0001'})
+
+    def test_elements_to_str(self):
+        groups = {'admin': 'https://auth.globus.org/0001', 'reader': 'https://auth.globus.org/0002'}
+        schema = em.Schema.define('TestSchema', acls={'select': [groups['reader']]})
+        schema['tables'] = {
+            name: em.Table.define(name, column_defs=[em.Column.define('Field', em.builtin_types['text'])],
+                                  acls=acls, provide_system=False)
+            for name, acls in [('Table1', {'select': [groups['admin']]}), ('Table2', {})]
+        }
+        model = em.Model({'annotations': {}, 'acls': {}, 'schemas': {'TestSchema': schema}})
+        catalog = LoopbackCatalog(model, server_uri='https://host.local/ermrest/catalog/1')
+        elements = [('TestSchema', None), ('TestSchema', 'Table1'), ('TestSchema', 'Table2')]
+
+        files = {}
+        for jobs in [1, 2]:
+            stringer = DerivaCatalogToString(catalog, groups=groups)
+            files[jobs] = list(stringer.elements_to_str(elements, jobs=jobs))
+            self.assertEqual(stringer._referenced_groups, groups)
+        self.assertEqual(files[1], files[2])
+        # Each file only declares the groups that it uses.
+        self.assertIn("groups = {'reader': 'https://auth.globus.org/0002'}", files[1][0])
+        self.assertIn("groups = {'admin': 'https://auth.globus.org/0001'}", files[1][1])
+        self.assertIn("groups = {}", files[1][2])
+
+    def test_dump_manifest(self):
+        table = em.Table.define('Table1', column_defs=[em.Column.define('Field', em.builtin_types['text'])])
+        model_doc = {'annotations': {}, 'acls': {},
+                     'schemas': {'TestSchema': dict(em.Schema.define('TestSchema'), tables={'Table1': table})}}
+        manifest = dump_manifest(model_doc, 'host.local', 1, {})
+        self.assertEqual(sorted(manifest['files']), ['TestSchema.schema.py', 'TestSchema/Table1.py', 'host.local_1.py'])
+
+        dumpdir = tempfile.mkdtemp()
+        for filename in manifest['files']:
+            os.makedirs(os.path.dirname(os.path.join(dumpdir, filename)), exist_ok=True)
+            open(os.path.join(dumpdir, filename), 'w').close()
+        self.assertEqual(changed_files(manifest, manifest, dumpdir), (set(), []))
+
+        table['comment'] = 'A new comment'
+        model_doc['schemas']['TestSchema']['tables']['Table2'] = em.Table.define('Table2', column_defs=[])
+        new_manifest = dump_manifest(model_doc, 'host.local', 1, {})
+        self.assertEqual(changed_files(manifest, new_manifest, dumpdir),
+                         ({'TestSchema.schema.py', 'TestSchema/Table1.py', 'TestSchema/Table2.py'}, []))
+        self.assertEqual(changed_files(new_manifest, manifest, dumpdir),
+                         ({'TestSchema.schema.py', 'TestSchema/Table1.py'}, ['TestSchema/Table2.py']))
+        # A change to the groups means every file is rendered again.
+        new_manifest = dump_manifest(model_doc, 'host.local', 1, {'admin': 'https://auth.globus.org/0001'})
+        self.assertEqual(len(changed_files(manifest, new_manifest, dumpdir)[0]), 4)
+
+        # The file of a schema that isn't dumped is kept until the schema is dropped from the catalog.
+        manifest = dump_manifest(model_doc, 'host.local', 1, {})
+        skip_manifest = dump_manifest(model_doc, 'host.local', 1, {}, skip_schemas=['TestSchema'])
+        self.assertEqual(changed_files(manifest, skip_manifest, dumpdir, model_doc), ({'TestSchema/Table2.py'}, []))
+        self.assertEqual(skip_manifest['files'], manifest['files'])
+        model_doc['schemas'] = {}
+        skip_manifest = dump_manifest(model_doc, 'host.local', 1, {}, skip_schemas=['TestSchema'])
+        self.assertEqual(changed_files(manifest, skip_manifest, dumpdir, model_doc),
+                         (set(), ['TestSchema.schema.py', 'TestSchema/Table1.py', 'TestSchema/Table2.py']))
+
+    def test_formatters(self):
+        groups = {'admin': 'https://auth.globus.org/0001'}
+        table = em.Table.define('Table1', column_defs=[em.Column.define('Field', em.builtin_types['text'])],
+                                acls={'select': [groups['admin']]}, comment='A table')
+        schema = dict(em.Schema.define('TestSchema'), tables={'Table1': table})
+        catalog = LoopbackCatalog(em.Model({'annotations': {}, 'acls': {}, 'schemas': {'TestSchema': schema}}))
+
+        yapf_string = DerivaCatalogToString(catalog, groups=groups).table_to_str('TestSchema', 'Table1')
+        pprint_string = DerivaCatalogToString(catalog, groups=groups, formatter='pprint').table_to_str(
+            'TestSchema', 'Table1')
+        self.assertNotEqual(yapf_string, pprint_string)
+        # Both layouts define the same table.
+        definitions = []
+        for s in [yapf_string, pprint_string]:
+            variables = {}
+            exec(s, variables)
+            definitions.append((variables['table_def'], variables['groups']))
+        self.assertEqual(definitions[0], definitions[1])
+
+        cache_dir = tempfile.mkdtemp()
+        source = "x = {'a':1,\n 'b':2}\n"
+        self.assertEqual(yapf_format(source, cache_dir=cache_dir), yapf_format(source))
+        self.assertEqual(len([f for _, _, files in os.walk(cache_dir) for f in files]), 1)
+        self.assertEqual(yapf_format(source, cache_dir=cache_dir), yapf_format(source))
+
+    def test_snapshot_catalog(self):
+        table = em.Table.define('Table1', column_defs=[em.Column.define('Field', em.builtin_types['text'])],
+                                acls={'select': ['https://auth.globus.org/0001']})
+        snapshot = {
+            'server_uri': 'https://host.local/ermrest/catalog/7',
+            'snaptime': '2TA-1234',
+            'schema': {'annotations': {}, 'acls': {},
+                       'schemas': {'TestSchema': dict(em.Schema.define('TestSchema'), tables={'Table1': table})}},
+            'groups': [{'ID': 'https://auth.globus.org/0001', 'Display_Name': 'admin'}]
+        }
+        tdir = tempfile.mkdtemp()
+        filename = '{}/snapshot.json.gz'.format(tdir)
+        with gzip.open(filename, 'wt') as f:
+            json.dump(snapshot, f)
+
+        catalog = SnapshotCatalog(filename)
+        self.assertEqual(catalog.get_server_uri(), snapshot['server_uri'])
+        self.assertEqual(catalog.get('/schema').json(), snapshot['schema'])
+        self.assertEqual(catalog.get('/').json(), {'snaptime': snapshot['snaptime']})
+        table_string = DerivaCatalogToString(catalog).table_to_str('TestSchema', 'Table1')
+        self.assertIn("groups = {'admin': 'https://auth.globus.org/0001'}", table_string)
+        self.assertIn("catalog_id = 7", table_string)
+
+        # Saving the snapshot catalog gives back the same snapshot.
+        copy_filename = '{}/copy.json.gz'.format(tdir)
+        save_catalog_snapshot(catalog, copy_filename)
+        with gzip.open(copy_filename, 'rt') as f:
+            self.assertEqual(json.load(f), snapshot)
 
     def test_variable_to_str(self):
         pass